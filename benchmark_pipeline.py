@@ -0,0 +1,250 @@
+"""
+
+benchmark_pipeline.py
+
+Synthetic-data benchmark for the picking pipeline.
+
+For every requested scale (number of particles), generates cryosparc-shaped inputs in a scratch directory:
+ - a manual-pick .cs with three clicks per vesicle
+ - a particle stack .cs over the same micrographs, used as the picking template
+then times and memory-profiles each stage on them:
+ - cs_to_vesicle_model    .cs manual picks -> vesicle model
+ - autopick               procedural picks for every vesicle
+ - spoofer                picks -> cryosparc particle array + particle-vesicle map
+ - id_correlate           curated subset of the picks -> original picks
+ - qc_filter              drop the particles of "problem" micrographs
+ - merge_cs               concatenate two particle files
+
+Each stage records wall time, CPU time, and peak resident memory (sampled from /proc while the stage
+runs, or the process high-water mark where /proc isn't available).  Results are written as json.
+
+Usage:
+	python benchmark_pipeline.py nParticles [nParticles ...] [--out=results.json] [--stages=a,b,...]
+
+"""
+
+
+import sys
+import os
+import io
+import json
+import time
+import shutil
+import platform
+import tempfile
+import contextlib
+import numpy as np
+from profiling import RssSampler
+
+
+# Geometry of the synthetic micrographs and picks
+MCG_H = 4092
+MCG_W = 5760
+BOX_SIZE_PX = 256
+PX_SIZE = 1.06
+PARTICLES_PER_VESICLE = 10
+VESICLES_PER_MCG = 40
+
+STAGES = ["cs_to_vesicle_model", "autopick", "spoofer", "id_correlate", "qc_filter", "merge_cs"]
+
+
+def main(scales, outJson, stages):
+	# The pipeline scripts live next to this one
+	sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+	results = {
+		"python": platform.python_version(),
+		"numpy": np.__version__,
+		"platform": platform.platform(),
+		"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+		"runs": [],
+	}
+	for n_particles in scales:
+		print("Benchmarking "+str(n_particles)+" particles...")
+		results["runs"].extend(run_scale(n_particles, stages))
+
+	with open(outJson, "w") as g:
+		json.dump(results, g, indent=1)
+	print("Results written to "+outJson)
+
+
+def run_scale(n_particles, stages, seed=0):
+	"""
+	Generates inputs for one scale in a scratch directory and runs the requested stages there.
+	"""
+	import cs_to_vesicle_model
+	import vesicle_procedural_pick
+	import vesicle_pick_pusher
+	import qc_cs_picks
+	import merge_cs
+	from vesicle_model import load_model
+	from particle_map import from_picks
+
+	records = []
+	n_vesicles = max(1, n_particles // PARTICLES_PER_VESICLE)
+	n_mcg = max(1, n_vesicles // VESICLES_PER_MCG)
+	rng = np.random.default_rng(seed)
+
+	home = os.getcwd()
+	scratch = tempfile.mkdtemp(prefix="vesicle_bench_")
+	try:
+		os.chdir(scratch)
+		mcg_uids, mcg_paths = make_micrographs(n_mcg, rng)
+		np.save("manual_picks.npy", make_manual_picks(n_vesicles, mcg_uids, mcg_paths, rng))
+		os.replace("manual_picks.npy", "manual_picks.cs")
+		np.save("particles.npy", make_particles(n_particles, mcg_uids, mcg_paths, rng))
+		os.replace("particles.npy", "particles.cs")
+
+		# Every stage runs when asked for, or when a later stage needs its output
+		if "cs_to_vesicle_model" in stages:
+			run_stage(records, n_particles, "cs_to_vesicle_model", 3*n_vesicles, cs_to_vesicle_model.main, "J0", "manual_picks.cs", 3)
+		else:
+			with contextlib.redirect_stdout(io.StringIO()):
+				cs_to_vesicle_model.main("J0", "manual_picks.cs", 3)
+		vesicle_model = load_model("./Vesicle_data/manual_picks.npz")
+
+		picks = None
+		if set(stages) & set(["autopick", "spoofer", "id_correlate"]):
+			picks = run_stage(records if "autopick" in stages else None, n_particles, "autopick", len(vesicle_model), vesicle_procedural_pick.pick_model, vesicle_model, BOX_SIZE_PX, 20 / PX_SIZE, 0.3, False)
+			picks, all_radii_px = picks
+			cs_template = vesicle_procedural_pick.load_template("particles.cs")
+			cs_array = run_stage(records if "spoofer" in stages else None, n_particles, "spoofer", len(picks["uid"]), vesicle_procedural_pick.spoofer, cs_template, picks, BOX_SIZE_PX)
+			particle_map = from_picks(picks, vesicle_model.ves_keys)
+
+		if "id_correlate" in stages:
+			curated = make_curated_subset(cs_array, rng)
+			run_stage(records, n_particles, "id_correlate", len(curated), vesicle_pick_pusher.id_correlate, "J0", curated, particle_map, vesicle_model)
+
+		if "qc_filter" in stages:
+			problem_keys = rng.choice(mcg_uids, size=max(1, n_mcg // 10), replace=False)
+			run_stage(records, n_particles, "qc_filter", n_particles, qc_cs_picks.write_subset, "particles.cs", "particles_subset.cs", problem_keys)
+
+		if "merge_cs" in stages:
+			run_stage(records, n_particles, "merge_cs", 2*n_particles, merge_cs.main, ["particles.cs", "particles.cs"])
+	finally:
+		os.chdir(home)
+		shutil.rmtree(scratch, ignore_errors=True)
+
+	return records
+
+
+def run_stage(records, scale, stage, rows, func, *args):
+	"""
+	Runs func(*args) with its output silenced, appends a timing record to records (unless records is
+	None), and returns func's result.
+	"""
+	sampler = RssSampler()
+	sampler.start()
+	wall_start = time.perf_counter()
+	cpu_start = time.process_time()
+	with contextlib.redirect_stdout(io.StringIO()):
+		result = func(*args)
+	cpu_s = time.process_time() - cpu_start
+	wall_s = time.perf_counter() - wall_start
+	peak_rss = sampler.stop()
+
+	if records is not None:
+		records.append({
+			"particles": scale,
+			"stage": stage,
+			"rows": int(rows),
+			"wall_s": round(wall_s, 4),
+			"cpu_s": round(cpu_s, 4),
+			"peak_rss_mb": round(peak_rss / 2**20, 1),
+		})
+		print("\t"+stage+": "+str(round(wall_s, 3))+" s, "+str(round(peak_rss / 2**20, 1))+" MB")
+	return result
+
+
+def particle_dtype():
+	""" Field layout of a cryosparc extracted particle stack. """
+	return np.dtype([
+		("uid", "<u8"),
+		("blob/path", "S72"),
+		("blob/idx", "<u4"),
+		("blob/shape", "<u4", (2,)),
+		("blob/psize_A", "<f4"),
+		("blob/sign", "<f4"),
+		("blob/import_sig", "<u8"),
+		("location/micrograph_uid", "<u8"),
+		("location/exp_group_id", "<u4"),
+		("location/micrograph_path", "S96"),
+		("location/micrograph_shape", "<u4", (2,)),
+		("location/center_x_frac", "<f4"),
+		("location/center_y_frac", "<f4"),
+	])
+
+
+def make_micrographs(n_mcg, rng):
+	""" Random micrograph uids and matching motion-corrected micrograph paths. """
+	mcg_uids = np.uint64(10**17) + np.cumsum(rng.integers(1, 10**9, size=n_mcg, dtype=np.uint64))
+	mcg_paths = np.asarray(["J2/motioncorrected/"+str(uid)+"_FoilHole_"+str(i)+"_Data_patch_aligned_doseweighted.mrc" for i, uid in enumerate(mcg_uids.tolist())], dtype="S96")
+	return mcg_uids, mcg_paths
+
+
+def fill_particles(n_rows, mcg_uids, mcg_paths, row_mcg, rng):
+	""" Builds a particle array on the given micrographs with every field populated. """
+	particles = np.zeros(n_rows, dtype=particle_dtype())
+	particles["uid"] = rng.integers(1, 2**63, size=n_rows, dtype=np.uint64)
+	particles["blob/path"] = b"J3/extract/particles_from_micrographs.mrc"
+	particles["blob/idx"] = np.arange(n_rows) % 1000
+	particles["blob/shape"] = BOX_SIZE_PX
+	particles["blob/psize_A"] = PX_SIZE
+	particles["blob/sign"] = -1
+	particles["location/micrograph_uid"] = mcg_uids[row_mcg]
+	particles["location/micrograph_path"] = mcg_paths[row_mcg]
+	particles["location/micrograph_shape"] = (MCG_H, MCG_W)
+	return particles
+
+
+def make_manual_picks(n_vesicles, mcg_uids, mcg_paths, rng):
+	"""
+	Three clicks on the rim of every vesicle, with vesicles spread evenly over the micrographs and
+	clicks in vesicle order, as cryosparc manual picking exports them.
+	"""
+	ves_mcg = np.sort(np.arange(n_vesicles) % len(mcg_uids))
+	center_x = rng.uniform(300, MCG_W - 300, n_vesicles)
+	center_y = rng.uniform(300, MCG_H - 300, n_vesicles)
+	radius = rng.uniform(100, 600, n_vesicles)
+
+	# Spread the three clicks around the rim so the circle is well determined
+	angle = rng.uniform(0, 2*np.pi, n_vesicles)[:, np.newaxis] + np.asarray([0, 2.1, 4.2])[np.newaxis, :]
+	click_x = np.clip(center_x[:, np.newaxis] + radius[:, np.newaxis] * np.cos(angle), 1, MCG_W - 1).reshape(-1)
+	click_y = np.clip(center_y[:, np.newaxis] + radius[:, np.newaxis] * np.sin(angle), 1, MCG_H - 1).reshape(-1)
+
+	picks = fill_particles(3*n_vesicles, mcg_uids, mcg_paths, np.repeat(ves_mcg, 3), rng)
+	picks["location/center_x_frac"] = click_x / MCG_W
+	picks["location/center_y_frac"] = click_y / MCG_H
+	return picks
+
+
+def make_particles(n_particles, mcg_uids, mcg_paths, rng):
+	""" A particle stack with uniformly placed particles on every micrograph. """
+	row_mcg = np.sort(np.arange(n_particles) % len(mcg_uids))
+	particles = fill_particles(n_particles, mcg_uids, mcg_paths, row_mcg, rng)
+	particles["location/center_x_frac"] = rng.uniform(0, 1, n_particles)
+	particles["location/center_y_frac"] = rng.uniform(0, 1, n_particles)
+	return particles
+
+
+def make_curated_subset(cs_array, rng, keep_fraction=0.5):
+	"""
+	Mimics a curated cryosparc export of a pick set: a random subset of rows, new uids, and coordinates
+	snapped to whole pixels.
+	"""
+	curated = cs_array[np.sort(rng.choice(len(cs_array), size=int(len(cs_array)*keep_fraction), replace=False))]
+	curated["uid"] = rng.integers(1, 2**63, size=len(curated), dtype=np.uint64)
+	curated["location/center_x_frac"] = np.round(curated["location/center_x_frac"] * MCG_W) / MCG_W
+	curated["location/center_y_frac"] = np.round(curated["location/center_y_frac"] * MCG_H) / MCG_H
+	return curated
+
+
+if __name__ == "__main__":
+	args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+	options = dict([arg[2:].split("=", 1) for arg in sys.argv[1:] if arg.startswith("--") and "=" in arg])
+	if (len(args) >= 1) and all([arg.isdigit() for arg in args]):
+		stages = options["stages"].split(",") if "stages" in options else STAGES
+		main([int(arg) for arg in args], options.get("out", "benchmark_results.json"), stages)
+	else:
+		print("Check usage: python foo.py nParticles [nParticles ...] [--out=results.json] [--stages=a,b,...]")
+		exit()
@@ -0,0 +1,163 @@
+"""
+
+check_matching.py
+
+Checks the one-to-one matching of curated particles to original picks against brute force.
+
+ - spatial_index.mutual_best_matches is compared with accepting candidate pairs one at a time in order of
+   distance, on random pair lists that include long chains of competing candidates.
+ - vesicle_pick_pusher.id_correlate is compared with every curated particle measured against every pick
+   on its micrograph, then matched greedily the same way.  The curated set is a jittered subset of the
+   picks with duplicated rows, near-misses just outside the tolerance and particles with no pick at all.
+   This runs on a single-file model, then on a model merged from two files whose vesicle keys repeat,
+   with the particle map both as picked and read back from json; push_setup must also find the center
+   of each pick's own vesicle.
+
+Prints the number of mismatches of each and exits with status 1 on any.
+
+Usage:
+	python check_matching.py [nPicks] [seed]
+
+"""
+
+
+import sys
+import io
+import contextlib
+import numpy as np
+from vesicle_model import from_arrays, merge_models
+from particle_map import from_picks, from_dict
+from spatial_index import mutual_best_matches
+from vesicle_pick_pusher import id_correlate, push_setup, MATCH_TOLERANCE_PX
+
+
+# Synthetic micrograph size (px) and picks per micrograph
+MCG_SIZE = 4096
+PICKS_PER_MCG = 2000
+
+
+def main(n_picks, seed):
+	rng = np.random.default_rng(seed)
+	pair_mismatches = check_pairs(rng)
+	print("mutual_best_matches: "+str(pair_mismatches)+" mismatch(es) over 200 random pair lists.")
+	correlate_mismatches = 0
+	for merged, json_map, label in [(False, False, "single file"), (True, False, "merged"), (True, True, "merged, json map")]:
+		mismatches, n_rows = check_correlate(rng, n_picks, merged, json_map)
+		print("id_correlate ("+label+"): "+str(mismatches)+" mismatch(es) over "+str(n_rows)+" curated particles (seed "+str(seed)+").")
+		correlate_mismatches += mismatches
+	if pair_mismatches + correlate_mismatches > 0:
+		exit(1)
+
+
+def check_pairs(rng):
+	""" Random candidate pairs, half of them laid out as chains, matched both ways. """
+	mismatches = 0
+	for trial in range(0, 200):
+		n = int(rng.integers(1, 2000))
+		query = rng.integers(0, max(1, n // 2), n)
+		point = rng.integers(0, max(1, n // 2), n)
+		distance = np.round(rng.uniform(0, 1, n), 2)
+		if trial % 2 == 1:
+			# Chain: query i prefers point i+1 to point i, but point i+1 prefers query i+1, so only the end of
+			# the chain is a mutual choice and each round settles one more link
+			chain = np.arange(n)
+			query = np.concatenate((chain, chain))
+			point = np.concatenate((chain, chain + 1))
+			distance = np.concatenate((1 - chain / n, 1 - chain / n - 1 / (2*n)))
+		kept = mutual_best_matches(query, point, distance)
+		reference = greedy_matches(query, point, distance)
+		if sorted(zip(kept[0].tolist(), kept[1].tolist())) != sorted(zip(reference[0].tolist(), reference[1].tolist())):
+			mismatches += 1
+	return mismatches
+
+
+def check_correlate(rng, n_picks, merged=False, json_map=False):
+	"""
+	A synthetic model, particle map and curated cs array, correlated by id_correlate and by brute force.
+	Returns the number of curated particles matched differently, plus matched particles whose push_setup
+	center is not their own vesicle's, and the number of curated particles.
+	"""
+	n_mcg = max(2, n_picks // PICKS_PER_MCG)
+	mcg_names = [str(1000000 + i)+"_FoilHole_"+str(i)+"_patch_aligned_doseweighted.mrc" for i in range(0, n_mcg)]
+
+	# One vesicle per micrograph is enough, each with its own center; picks are placed freely over the
+	# micrograph.  A merged model joins two files that both number their vesicles from 0
+	centers = np.stack((np.arange(n_mcg), np.arange(n_mcg)), axis=1)
+	if merged == True:
+		half = n_mcg // 2
+		files = [from_arrays(mcg_names[start:stop], np.full(stop - start, MCG_SIZE), np.full(stop - start, MCG_SIZE), np.arange(stop - start), [str(i) for i in range(0, stop - start)], centers[start:stop], np.full(stop - start, 500), np.full(stop - start, 256)) for start, stop in [(0, half), (half, n_mcg)]]
+		vesicle_model = merge_models(files)
+	else:
+		vesicle_model = from_arrays(mcg_names, np.full(n_mcg, MCG_SIZE), np.full(n_mcg, MCG_SIZE), np.arange(n_mcg), [str(i) for i in range(0, n_mcg)], centers, np.full(n_mcg, 500), np.full(n_mcg, 256))
+	pick_mcg = rng.integers(0, n_mcg, n_picks)
+	pick_x = rng.uniform(1, MCG_SIZE - 1, n_picks)
+	pick_y = rng.uniform(1, MCG_SIZE - 1, n_picks)
+	particle_map = from_picks({"uid": np.arange(n_picks), "x_frac": pick_x / MCG_SIZE, "y_frac": pick_y / MCG_SIZE, "vesicle": pick_mcg, "angle": np.zeros(n_picks), "r_eff": np.full(n_picks, 500.0)}, vesicle_model.ves_keys)
+	if json_map == True:
+		particle_map = from_dict(particle_map.to_dict())
+
+	# Curated rows: a jittered subset, duplicates of some of them, near-misses and strays
+	subset = rng.choice(n_picks, n_picks // 2, replace=False)
+	row_src = np.concatenate((subset, subset[0:len(subset) // 10], rng.choice(n_picks, n_picks // 20)))
+	jitter = np.concatenate((rng.uniform(0, 0.7, len(subset) + len(subset) // 10), rng.uniform(0.95, 1.05, n_picks // 20)))
+	angle = rng.uniform(0, 2*np.pi, len(row_src))
+	row_mcg = pick_mcg[row_src]
+	row_x = pick_x[row_src] + jitter * np.cos(angle)
+	row_y = pick_y[row_src] + jitter * np.sin(angle)
+	strays = n_picks // 50
+	row_mcg = np.concatenate((row_mcg, rng.integers(0, n_mcg, strays)))
+	row_x = np.concatenate((row_x, rng.uniform(1, MCG_SIZE - 1, strays)))
+	row_y = np.concatenate((row_y, rng.uniform(1, MCG_SIZE - 1, strays)))
+
+	cs_file = np.zeros(len(row_x), dtype=[("location/micrograph_path", "S80"), ("location/micrograph_shape", "<u4", (2,)), ("location/center_x_frac", "<f4"), ("location/center_y_frac", "<f4")])
+	cs_file["location/micrograph_path"] = np.asarray(["J1/motioncorrected/"+name for name in mcg_names], dtype="S80")[row_mcg]
+	cs_file["location/micrograph_shape"] = MCG_SIZE
+	cs_file["location/center_x_frac"] = row_x / MCG_SIZE
+	cs_file["location/center_y_frac"] = row_y / MCG_SIZE
+
+	with contextlib.redirect_stdout(io.StringIO()):
+		map_rows = id_correlate("J1", cs_file, particle_map, vesicle_model)
+	setup = push_setup(cs_file, map_rows, particle_map, vesicle_model)
+	wrong_center = np.count_nonzero(setup["center_x"] != pick_mcg[setup["picks"]])
+
+	# Brute force, in the coordinates id_correlate sees (float32 fractions scaled back to pixels)
+	part_x = np.asarray(particle_map.x, dtype=np.float64) * MCG_SIZE
+	part_y = np.asarray(particle_map.y, dtype=np.float64) * MCG_SIZE
+	curated_x = cs_file["location/center_x_frac"] * cs_file["location/micrograph_shape"][:, 1]
+	curated_y = cs_file["location/center_y_frac"] * cs_file["location/micrograph_shape"][:, 0]
+	query, point, distance = [], [], []
+	for mcg in range(0, n_mcg):
+		rows = np.flatnonzero(row_mcg == mcg)
+		picks = np.flatnonzero(pick_mcg == mcg)
+		d = np.hypot(part_x[picks][np.newaxis, :] - curated_x[rows][:, np.newaxis], part_y[picks][np.newaxis, :] - curated_y[rows][:, np.newaxis])
+		near_row, near_pick = np.nonzero(d <= MATCH_TOLERANCE_PX)
+		query.append(rows[near_row])
+		point.append(picks[near_pick])
+		distance.append(d[near_row, near_pick])
+	match_row, match_pick, match_dist = greedy_matches(np.concatenate(query), np.concatenate(point), np.concatenate(distance))
+	reference = np.full(len(row_x), -1, dtype=np.int64)
+	reference[match_row] = match_pick
+	return int(np.count_nonzero(map_rows != reference) + wrong_center), len(row_x)
+
+
+def greedy_matches(query, point, distance):
+	""" Accepts pairs one at a time in order of distance (ties to the lowest query, then point). """
+	kept_q, kept_p, kept_d = [], [], []
+	taken_q = set()
+	taken_p = set()
+	for i in np.lexsort((point, query, distance)).tolist():
+		if (query[i] not in taken_q) and (point[i] not in taken_p):
+			taken_q.add(query[i])
+			taken_p.add(point[i])
+			kept_q.append(query[i])
+			kept_p.append(point[i])
+			kept_d.append(distance[i])
+	return np.asarray(kept_q, dtype=np.int64), np.asarray(kept_p, dtype=np.int64), np.asarray(kept_d)
+
+
+if __name__ == "__main__":
+	if len(sys.argv) <= 3:
+		main(int(sys.argv[1]) if len(sys.argv) >= 2 else 200000, int(sys.argv[2]) if len(sys.argv) == 3 else 0)
+	else:
+		print("Check usage: python foo.py [nPicks] [seed]")
+		exit()
@@ -0,0 +1,82 @@
+"""
+
+check_ring_counts.py
+
+Checks vesicle_procedural_pick.ring_counts against the original trial loop of autopick, which raised div
+from 3 one box at a time until get_overlap of the first two boxes reached the target overlap.
+
+Draws random rings (center 0..4096 px, effective radius -300..8000 px, box 64..400 px, overlap 0.1..0.95),
+computes div both ways and prints the number of rings where they disagree.  Exits with status 1 on any
+mismatch.
+
+Usage:
+	python check_ring_counts.py [nRings] [seed]
+
+"""
+
+
+import sys
+import numpy as np
+from math import pi, sin, cos
+from vesicle_procedural_pick import ring_counts
+
+
+# The reference loop gives up past this many boxes (no ring in the sampled ranges needs that many)
+MAX_DIV = 100000
+
+
+def main(n_rings, seed):
+	rng = np.random.default_rng(seed)
+	x = rng.uniform(0, 4096, n_rings)
+	y = rng.uniform(0, 4096, n_rings)
+	r_eff = rng.uniform(-300, 8000, n_rings)
+	box_size_px = rng.integers(64, 401, n_rings)
+	user_overlap = rng.uniform(0.1, 0.95, n_rings)
+
+	mismatches = 0
+	for i in range(0, n_rings):
+		div = ring_counts(x[i:i+1], y[i:i+1], r_eff[i:i+1], int(box_size_px[i]), float(user_overlap[i]))[0]
+		if div != trial_div(x[i], y[i], r_eff[i], int(box_size_px[i]), float(user_overlap[i])):
+			mismatches += 1
+	print("Checked "+str(n_rings)+" rings (seed "+str(seed)+"): "+str(mismatches)+" mismatch(es).")
+	if mismatches > 0:
+		exit(1)
+
+
+def trial_div(x, y, r_eff, box_size_px, user_overlap):
+	""" div as the original autopick loop found it, one box at a time. """
+	box_area_px = box_size_px ** 2
+	div = 2
+	calc_overlap = float(0)
+	while (calc_overlap < user_overlap) and (div < MAX_DIV):
+		div += 1
+		alpha = 2 * pi / div
+		x1 = x + r_eff * cos(0.0)
+		y1 = y + -1 * r_eff * sin(0.0)
+		x2 = x + r_eff * cos(alpha)
+		y2 = y + -1 * r_eff * sin(alpha)
+		calc_overlap = get_overlap(int(x1), int(y1), int(x2), int(y2), box_size_px, box_area_px)
+	return div
+
+
+def get_overlap(x1, y1, x2, y2, box_size, box_area):
+	# Define pick square edges
+	x1_2 = x1 + (box_size/2)
+	y1_2 = y1 + (box_size/2)
+	x2_1 = x2 - (box_size/2)
+	y2_1 = y2 - (box_size/2)
+
+	# Exit if there is no overlap
+	if (x1_2 <= x2_1) or (y1_2 <= y2_1):
+		return float(0)
+	else: # Calculate if we know we have overlap
+		overlap_area = (x1_2 - x2_1) * (y1_2 - y2_1)
+		return ((2*box_area) - overlap_area) / box_area
+
+
+if __name__ == "__main__":
+	if len(sys.argv) <= 3:
+		main(int(sys.argv[1]) if len(sys.argv) >= 2 else 20000, int(sys.argv[2]) if len(sys.argv) == 3 else 0)
+	else:
+		print("Check usage: python foo.py [nRings] [seed]")
+		exit()
@@ -0,0 +1,196 @@
+"""
+
+cs_io.py
+
+Shared helpers for reading cryosparc .cs particle files.
+
+Columns are located by the field names in the structured dtype (e.g. "location/center_x_frac") instead
+of by probing rows, and the resolved layout is cached per dtype.  Column access returns views into the
+loaded array, so nothing is copied until a script does arithmetic on them.
+
+Files are opened memory-mapped, or streamed in fixed-size row blocks, so that scripts hold bounded
+memory regardless of the size of the particle stack.  Outputs are preallocated as memory-mapped .npy
+files and renamed into place once filled.
+
+"""
+
+
+import os
+import ast
+import struct
+import functools
+import numpy as np
+
+
+# Rows per block when streaming a cs file
+CHUNK_ROWS = 500000
+
+
+# Named columns, and the cryosparc fields that can supply them in order of preference
+CS_FIELDS = {
+	"uid": ["uid"],
+	"blob_path": ["blob/path"],
+	"box_shape": ["blob/shape"],
+	"psize": ["blob/psize_A", "location/micrograph_psize_A"],
+	"mcg_uid": ["location/micrograph_uid"],
+	"mcg_path": ["location/micrograph_path"],
+	"mcg_shape": ["location/micrograph_shape"],
+	"x_frac": ["location/center_x_frac"],
+	"y_frac": ["location/center_y_frac"],
+	"vesicle_id": ["vesicle/id", "vesicle_id"],
+}
+
+
+@functools.lru_cache(maxsize=None)
+def resolve_fields(cs_dtype):
+	"""
+	Maps every named column in CS_FIELDS onto the dtype field that supplies it, or None if the dtype
+	has no such field.  Cached per dtype, so repeated lookups cost a dict access.
+	"""
+	names = cs_dtype.names or ()
+	resolved = {}
+	for column in CS_FIELDS:
+		resolved[column] = None
+		for field in CS_FIELDS[column]:
+			if field in names:
+				resolved[column] = field
+				break
+	return resolved
+
+
+def has_column(cs_array, column):
+	""" Returns True if the cs array provides the named column. """
+	return resolve_fields(cs_array.dtype)[column] is not None
+
+
+def cs_column(cs_array, column):
+	"""
+	Returns a zero-copy view of a named column (a key of CS_FIELDS) of the cs array.
+	"""
+	field = resolve_fields(cs_array.dtype)[column]
+	if field is None:
+		raise KeyError("cs file has no field for '"+column+"' (looked for "+", ".join(CS_FIELDS[column])+")")
+	return cs_array[field]
+
+
+def load_cs(inCs, mmap=True):
+	"""
+	Opens a cs file.  By default the file is memory-mapped read-only so that rows are only paged in when
+	touched.  Files with object fields would have to be unpickled, which can run arbitrary code, so they
+	raise ValueError instead of loading.
+	"""
+	check_fields(cs_header(inCs)[0], inCs)
+	if mmap == True:
+		return np.load(inCs, mmap_mode="r")
+	return np.load(inCs)
+
+
+def check_fields(cs_dtype, inCs):
+	""" Raises ValueError if a cs file has object (pickled) fields. """
+	if cs_dtype.hasobject:
+		raise ValueError(str(inCs)+" has object fields, which are not loaded because unpickling them can run arbitrary code.  Re-export it from cryosparc.")
+
+
+def cs_header(inCs):
+	"""
+	Reads the .npy header of a cs file without touching the data.  Returns the dtype, the number of rows
+	and the byte offset of the first row.  Format versions 1.0 and 2.0 are read by numpy; version 3.0 is
+	version 2.0 with a utf-8 header, which numpy has no public reader for.
+	"""
+	with open(inCs, "rb") as f:
+		version = np.lib.format.read_magic(f)
+		if version == (1, 0):
+			shape, fortran_order, cs_dtype = np.lib.format.read_array_header_1_0(f)
+		elif version == (2, 0):
+			shape, fortran_order, cs_dtype = np.lib.format.read_array_header_2_0(f)
+		elif version == (3, 0):
+			header_length = struct.unpack("<I", f.read(4))[0]
+			header = ast.literal_eval(f.read(header_length).decode("utf8"))
+			shape, cs_dtype = header["shape"], np.lib.format.descr_to_dtype(header["descr"])
+		else:
+			raise ValueError(str(inCs)+" is .npy format version "+str(version[0])+"."+str(version[1])+", which cs_io can't read.")
+		offset = f.tell()
+	return cs_dtype, int(np.prod(shape)), offset
+
+
+def iter_cs_chunks(inCs, chunk_rows=CHUNK_ROWS):
+	"""
+	Yields (start_row, block) pairs covering a cs file in order, chunk_rows rows at a time.  Given a path,
+	each block is read straight from disk into its own array so only one block is ever resident; given an
+	already-loaded (or memory-mapped) array, blocks are slices of it.
+	"""
+	if isinstance(inCs, np.ndarray):
+		for start in range(0, len(inCs), chunk_rows):
+			yield start, inCs[start:start+chunk_rows]
+		return
+
+	cs_dtype, n_rows, offset = cs_header(inCs)
+	check_fields(cs_dtype, inCs)
+	with open(inCs, "rb") as f:
+		f.seek(offset)
+		for start in range(0, n_rows, chunk_rows):
+			block = np.fromfile(f, dtype=cs_dtype, count=min(chunk_rows, n_rows-start))
+			yield start, block
+
+
+def create_cs(outCs, cs_dtype, n_rows):
+	"""
+	Preallocates an n_rows cs output as a memory-mapped .npy file with a valid header.  The file is
+	created under a temporary name in the destination directory; fill it in place, then pass it to
+	commit_cs to move it to outCs, or to discard_cs if filling it fails.
+	"""
+	temp_path = os.path.join(os.path.dirname(os.path.abspath(outCs)), "."+os.path.basename(outCs)+".tmp")
+	return np.lib.format.open_memmap(temp_path, mode="w+", dtype=cs_dtype, shape=(n_rows,))
+
+
+def commit_cs(out_array, outCs):
+	"""
+	Flushes a cs output created by create_cs and atomically renames it to outCs.
+	"""
+	temp_path = out_array.filename
+	out_array.flush()
+	del out_array
+	os.replace(temp_path, outCs)
+
+
+def discard_cs(out_array):
+	"""
+	Deletes a cs output created by create_cs without committing it, so a failed write leaves no temporary
+	file behind.
+	"""
+	if os.path.isfile(out_array.filename):
+		os.remove(out_array.filename)
+
+
+def micrograph_names(path_column):
+	"""
+	Decodes each distinct micrograph path once.  Returns the list of micrograph file names (path
+	component past the last slash) and an array mapping every row onto its entry in that list.
+	"""
+	paths, inverse = np.unique(path_column, return_inverse=True)
+	names = []
+	for path in paths:
+		if isinstance(path, bytes):
+			path = path.decode("ascii")
+		names.append(last_slash(str(path)))
+	return names, inverse.reshape(-1)
+
+
+def micrograph_keys(names):
+	"""
+	Returns the cryosparc micrograph uid prefix (digits before the first underscore) of each
+	micrograph name as a uint64 array, matching the location/micrograph_uid field.
+	"""
+	return np.asarray([int(name[0:name.find("_")]) for name in names], dtype=np.uint64)
+
+
+def last_slash(inStr):
+	"""
+	Returns the component of a string past the last forward slash character.
+	"""
+	prevPos = 0
+	currentPos = 0
+	while currentPos != -1:
+		prevPos = currentPos
+		currentPos = inStr.find("/", prevPos+1)
+	return inStr[prevPos+1:]
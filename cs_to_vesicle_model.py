@@ -7,161 +7,238 @@ cs_to_vesicle_model.py
 
 This script takes a cryosparc .cs file for particles or particle passthrough and exports the particle coordinates to a
 csv file containing vesicle center (x,y) and vesicle radius.
-Write out the model as  json with suffix "_vesicledata.json"
+Write out the model to ./Vesicle_data as a columnar .npz (see vesicle_model.py to convert to/from json).
+
+Clicks are grouped into vesicles by a vesicle id column ("vesicle/id" or "vesicle_id", any integer, unique
+per micrograph) if the .cs file has one, so a vesicle may have any number (three or more) of clicks in any
+order.  Otherwise clicks are taken in clicked order, clicksPerVesicle (three if not given, at least three)
+per vesicle, restarting at every change of micrograph so a vesicle never spans two micrographs and a stray
+click only disturbs the rest of its own micrograph.
+
+Given a directory or glob of .cs files instead, converts them in parallel and writes one merged model to
+./Vesicle_data/vesicle_model_merged.npz.
 
 """
 
 import sys
 import numpy as np
-import json
 import os
-from os import listdir
-from os.path import isfile, join
-import math
-import statistics
+import glob
+import multiprocessing
+from os.path import join
+from cs_io import cs_column, has_column, micrograph_names, iter_cs_chunks
+from vesicle_model import from_arrays, save_model, merge_models
+
 
+# Clicks per vesicle for files without a vesicle id column, if not given
+DEFAULT_CLICKS_PER_VESICLE = 3
 
-def main(csJobID, inCs):
+
+def main(csJobID, inCs, clicks_per_vesicle=None):
+	# csJobID is no longer needed to locate the micrograph field; kept so existing command lines still work
 	# Check for the Vesicle_data subdirectory
 	if os.path.isdir("./Vesicle_data") == False:
 		os.mkdir("./Vesicle_data")
 	else:
 		print("\nDetected a Vesicle_data folder in this directory.")
-	onlyfiles = [f for f in listdir("./Vesicle_data/") if isfile(join("./Vesicle_data", f))]
-
-	coord_dict = {}
-	out_dict = {}
 
-	# Read in the cs file as a np array
-	f = np.load(inCs)
+	# A directory or glob pattern switches to batch mode: convert every file and merge the results
+	if os.path.isdir(inCs) or glob.has_magic(inCs):
+		batch_convert(inCs, clicks_per_vesicle)
+		return
 
-	# Get the starting index for the particle location info
-	start_index = infer_index(f)
-
-	# Get the corresponding micrograph name
-	mcg_index = find_mcg_name(csJobID, f[0])
-	
-	# Load the particles into a dictionary.  Particles batched in groups of three defined by order clicked.
-	for i in range(0, len(f)):
-		if last_slash(str(f[i][mcg_index])).replace("'", "").replace('"', '') not in coord_dict:
-			coord_dict[last_slash(str(f[i][mcg_index])).replace("'", "").replace('"', '')] = {}
-		if int(i/3) not in coord_dict[last_slash(str(f[i][mcg_index])).replace("'", "").replace('"', '')]:
-			coord_dict[last_slash(str(f[i][mcg_index])).replace("'", "").replace('"', '')][int(i/3)] = []
-		
-		# Calculate transformed x and y coords
-		h = f[i][start_index+1][0]
-		l = f[i][start_index+1][1]
-		x_frac = f[i][start_index+2]
-		y_frac = f[i][start_index+3]
-		x_coord = round((l*x_frac), 0)
-		y_coord = round((h*y_frac), 0)
-
-		# Add to dictionary
-		coord_dict[last_slash(str(f[i][mcg_index])).replace("'", "").replace('"', '')][int(i/3)].append((x_coord, y_coord))
-
-		# To every coordinate set, add mcg_l, mcg_w, and box info
-		if i % 3 == 2:
-			# Grab parameters
-			mcg_l, mcg_w, box = get_sizes(f[i])
-			# Add to dictionary
-			coord_dict[last_slash(str(f[i][mcg_index])).replace("'", "").replace('"', '')][int(i/3)].append(mcg_l)
-			coord_dict[last_slash(str(f[i][mcg_index])).replace("'", "").replace('"', '')][int(i/3)].append(mcg_w)
-			coord_dict[last_slash(str(f[i][mcg_index])).replace("'", "").replace('"', '')][int(i/3)].append(box)
-
-	# Apply geometry to get circles
-	for thing in coord_dict:
-		if thing not in out_dict:
-			out_dict[thing] = {}
-		for item in coord_dict[thing]:
-			if item not in out_dict[thing]:
-				out_dict[thing][item] = {}
-			center, radius = circle_three_points(coord_dict[thing][item][0], coord_dict[thing][item][1], coord_dict[thing][item][2])
-			out_dict[thing][item]["center"] = center
-			out_dict[thing][item]["radius"] = radius
-			out_dict[thing][item]["mcg_h"] = coord_dict[thing][item][3]
-			out_dict[thing][item]["mcg_w"] = coord_dict[thing][item][4]
-			out_dict[thing][item]["box_size"] = coord_dict[thing][item][5]
-
-	# Write out to json
-	with open("./Vesicle_data/"+no_ext(inCs)+".json", "w") as g:
-		json.dump(out_dict, g)
+	vesicle_model = convert_cs(inCs, clicks_per_vesicle)
+	outModel = "./Vesicle_data/"+no_ext(os.path.basename(inCs))+".npz"
+	save_model(vesicle_model, outModel)
 
 	# Exit
-	print("\nProcessed "+str(int(len(f)/3))+" vesicles.")
-	print("\nVesicle data output to ./Vesicle_data/"+no_ext(inCs)+".json")
+	print("\nProcessed "+str(len(vesicle_model))+" vesicles.")
+	print("\nVesicle data output to "+outModel)
 	print("\n...done.")
 
 
-def get_sizes(inCs):
-	# Get the first two items that are numpy arrays
-	array_counter = 0
-	for i in range(0, len(inCs)):
-		if isinstance(inCs[i], np.ndarray) == True:
-			array_counter += 1
-			if array_counter == 1:
-				first_array = inCs[i]
-			elif array_counter == 2:
-				second_array = inCs[i]
-		if array_counter == 2:
-			break
-
-	# Extract data and return
-	mcg_h = int(second_array[0])
-	mcg_w = int(second_array[1])
-	box = int(first_array[0])
-	return mcg_h, mcg_w, box
-
-
-def circle_three_points(A, B, C):
-	# Define the slopes and intercepts of the perpendicular bisectors of vectors AB and BC
-	m_perpAB, b_perpAB = perp_bisect(A, B)
-	m_perpBC, b_perpBC = perp_bisect(B, C)
-
-	# Determine the intersection of the perpendicular bisectors, this is the *origin*
-	origin = get_intersection(m_perpAB, b_perpAB, m_perpBC, b_perpBC)
-
-	# Find the euclidian distance between the origin and A, this is the *radius* 
-	radius = int(round(statistics.mean([get_euclidian_distance(A, origin), get_euclidian_distance(B, origin), get_euclidian_distance(C, origin)]), 0))
-
-	return origin, radius
-
-
-def perp_bisect(A, B):
-	# If the y-vals are the same, we get meaningless values.  Have to add a pseudocount.
-	if A[1] == B[1]:
-		B = (B[0], (B[1]+0.0001))
-	if A[0] == B[0]:
-		B = ((B[0]+0.0001), B[1])
-
-	# Define slope and intercept for vector AB
-	m = (B[1] - A[1]) / (B[0] - A[0])
-	b = A[1] - (m * A[0])
-
-	# Slope of perpendicular is inverse reciprocal
-	m_perp = -1 / m
-
-	# Find the midpoint of AB
-	midpoint_x = (A[0] + B[0]) / 2
-	midpoint_y = (A[1] + B[1]) / 2
-
-	# Find the intercept that fulfills the midpoint and the known slope
-	b_perp = midpoint_y - (m_perp * midpoint_x)
-
-	return m_perp, b_perp
-
+def batch_convert(inPattern, clicks_per_vesicle=None, processes=None):
+	"""
+	Converts every .cs file in a directory (or matching a glob pattern) on a process pool and writes a
+	single merged model to ./Vesicle_data/vesicle_model_merged.npz.  Files are merged in sorted order, with
+	the same semantics as merge_vesicle_model.py.
+	"""
+	if os.path.isdir(inPattern):
+		inPattern = join(inPattern, "*.cs")
+	inFiles = sorted(glob.glob(inPattern))
+	if len(inFiles) == 0:
+		print("No .cs files found for "+inPattern+".  Exiting...")
+		exit()
+	print("\nConverting "+str(len(inFiles))+" files...")
+
+	# Each worker streams and fits one file; results come back in file order
+	with multiprocessing.Pool(processes=processes) as pool:
+		models = pool.starmap(convert_cs, [(inCs, clicks_per_vesicle) for inCs in inFiles])
+	vesicle_model = merge_models(models)
+
+	outModel = "./Vesicle_data/vesicle_model_merged.npz"
+	save_model(vesicle_model, outModel)
+	print("\nProcessed "+str(len(vesicle_model))+" vesicles from "+str(len(inFiles))+" files.")
+	print("\nVesicle data output to "+outModel)
+	print("\n...done.")
 
-def get_intersection(m1, b1, m2, b2):
-	x_int = (b2 - b1) / (m1 - m2)
-	y_int = (m1 * x_int) + b1
-	return (int(round(x_int, 0)), int(round(y_int, 0)))
 
+def convert_cs(inCs, clicks_per_vesicle=None):
+	"""
+	Fits vesicles to the manual picks of one cs file and returns them as a VesicleModel.  inCs may also be
+	an already-loaded cs array, so picks can come straight from another stage without a file in between.
+	Clicks are grouped by the vesicle id column, or by clicks_per_vesicle (DEFAULT_CLICKS_PER_VESICLE if
+	None) if the file has none; see click_groups.
+	"""
+	label = inCs if isinstance(inCs, str) else "cs array"
+
+	# Stream the cs file block by block, keeping only the columns needed to build the model
+	mcg_lookup = {}
+	x_blocks, y_blocks, mcg_blocks, h_blocks, w_blocks, box_blocks, id_blocks = [], [], [], [], [], [], []
+	for start, block in iter_cs_chunks(inCs):
+		# Decode each distinct micrograph path once, then map every row back onto it
+		block_names, block_inverse = micrograph_names(cs_column(block, "mcg_path"))
+		block_index = np.asarray([mcg_lookup.setdefault(name, len(mcg_lookup)) for name in block_names], dtype=np.int64)
+		mcg_blocks.append(block_index[block_inverse])
+
+		# Calculate transformed x and y coords for every particle in the block at once
+		mcg_shape = cs_column(block, "mcg_shape")
+		x_blocks.append(np.round(mcg_shape[:, 1] * cs_column(block, "x_frac"), 0))
+		y_blocks.append(np.round(mcg_shape[:, 0] * cs_column(block, "y_frac"), 0))
+		h_blocks.append(mcg_shape[:, 0].copy())
+		w_blocks.append(mcg_shape[:, 1].copy())
+		box_blocks.append(cs_column(block, "box_shape")[:, 0].copy())
+		if has_column(block, "vesicle_id"):
+			id_blocks.append(cs_column(block, "vesicle_id").astype(np.int64))
+	mcg_names = list(mcg_lookup.keys())
+	mcg_inverse = np.concatenate(mcg_blocks)
+	x_coords = np.concatenate(x_blocks)
+	y_coords = np.concatenate(y_blocks)
+	n_particles = len(x_coords)
+
+	# Batch the particles into vesicles, dropping clicks that don't complete one
+	if len(id_blocks) > 0:
+		group = click_groups(mcg_inverse, np.concatenate(id_blocks))
+	elif clicks_per_vesicle is not None:
+		group = click_groups(mcg_inverse, clicks_per_vesicle=clicks_per_vesicle)
+	else:
+		group = click_groups(mcg_inverse, clicks_per_vesicle=DEFAULT_CLICKS_PER_VESICLE)
+	used = np.flatnonzero(group >= 0)
+	if len(used) != n_particles:
+		print("\n"+label+": ignoring "+str(n_particles - len(used))+" particle(s) that do not complete a vesicle.")
+	group = group[used]
+
+	# Fit every vesicle in one call
+	ves_ids, centers, radii, fit_ok = fit_circles(x_coords[used], y_coords[used], group)
+	if np.count_nonzero(~fit_ok) > 0:
+		print("\n"+label+": skipping "+str(np.count_nonzero(~fit_ok))+" vesicle(s) whose clicks are collinear or repeated.")
+
+	# Every vesicle takes its micrograph, mcg_h, mcg_w, and box info from the last particle of its group
+	last_rows = used[last_in_group(group)][fit_ok]
+	ves_mcg = mcg_inverse[last_rows]
+	mcg_h = np.zeros(len(mcg_names), dtype=np.int64)
+	mcg_w = np.zeros(len(mcg_names), dtype=np.int64)
+	mcg_h[ves_mcg] = np.concatenate(h_blocks)[last_rows]
+	mcg_w[ves_mcg] = np.concatenate(w_blocks)[last_rows]
+	ves_box = np.concatenate(box_blocks)[last_rows].astype(np.int64)
+
+	# Assemble the model
+	return from_arrays(mcg_names, mcg_h, mcg_w, ves_mcg, ves_ids[fit_ok].astype(str), centers[fit_ok], radii[fit_ok], ves_box)
+
+
+def click_groups(mcg, vesicle_id=None, clicks_per_vesicle=None):
+	"""
+	Labels the vesicle of every click, numbering vesicles in order of their first click; -1 marks clicks
+	left out.  With vesicle_id, clicks sharing a micrograph and an id form one vesicle wherever they are
+	in the file, and groups of fewer than three clicks are left out.  Otherwise the clicks of every run
+	of consecutive rows on one micrograph are taken clicks_per_vesicle at a time, leaving out any
+	incomplete group at the end of the run.
+	"""
+	if vesicle_id is not None:
+		pairs = np.stack((np.asarray(mcg, dtype=np.int64), np.asarray(vesicle_id, dtype=np.int64)), axis=1)
+		labels, first_seen, inverse, counts = np.unique(pairs, axis=0, return_index=True, return_inverse=True, return_counts=True)
+		inverse = inverse.reshape(-1)
+		complete = counts >= 3
+		order = np.argsort(first_seen[complete], kind="stable")
+		renumber = np.full(len(labels), -1, dtype=np.int64)
+		renumber[np.flatnonzero(complete)[order]] = np.arange(len(order))
+		return renumber[inverse]
+
+	# Runs of consecutive clicks on the same micrograph
+	mcg = np.asarray(mcg)
+	run_start = np.flatnonzero(np.concatenate(([True], mcg[1:] != mcg[:-1])))
+	run_length = np.diff(np.concatenate((run_start, [len(mcg)])))
+	run = np.repeat(np.arange(len(run_start)), run_length)
+	position = np.arange(len(mcg)) - run_start[run]
+
+	# Number the complete groups of every run on from those of the runs before it
+	run_groups = run_length // clicks_per_vesicle
+	first_group = np.cumsum(run_groups) - run_groups
+	group = first_group[run] + position // clicks_per_vesicle
+	group[position >= (run_groups * clicks_per_vesicle)[run]] = -1
+	return group
+
+
+def fit_circles(x, y, group):
+	"""
+	Algebraic least-squares (Kasa) circle fit for every vesicle at once.  x and y are the clicked points
+	and group labels the vesicle each point belongs to, in any order; each vesicle needs three or more
+	clicks.  For exactly three clicks this is the circle through all three.
 
-def get_euclidian_distance(A, B):
-	y1 = A[1]
-	y2 = B[1]
-	x1 = A[0]
-	x2 = B[0]
-	return math.sqrt((y2-y1)**2 + (x2-x1)**2)
+	Returns the sorted group labels, integer centers [x, y], integer radii, and a mask that is False for
+	vesicles that can't be fit (fewer than three clicks, or clicks that are collinear or repeated).
+	"""
+	labels, inverse = np.unique(group, return_inverse=True)
+	inverse = inverse.reshape(-1)
+	n_groups = len(labels)
+	counts = np.bincount(inverse, minlength=n_groups).astype(np.float64)
+
+	def group_sum(values):
+		return np.bincount(inverse, weights=values, minlength=n_groups)
+
+	# Work relative to each vesicle's centroid to keep the normal equations well conditioned
+	mean_x = group_sum(x) / counts
+	mean_y = group_sum(y) / counts
+	u = x - mean_x[inverse]
+	v = y - mean_y[inverse]
+	z = u*u + v*v
+
+	# Normal equations for u^2 + v^2 + D*u + E*v + F = 0, one 3x3 system per vesicle
+	normal = np.empty((n_groups, 3, 3))
+	normal[:, 0, 0] = group_sum(u*u)
+	normal[:, 0, 1] = normal[:, 1, 0] = group_sum(u*v)
+	normal[:, 0, 2] = normal[:, 2, 0] = group_sum(u)
+	normal[:, 1, 1] = group_sum(v*v)
+	normal[:, 1, 2] = normal[:, 2, 1] = group_sum(v)
+	normal[:, 2, 2] = counts
+	rhs = -np.stack((group_sum(u*z), group_sum(v*z), group_sum(z)), axis=1)
+
+	# Collinear or repeated clicks make the system singular; swap in a dummy system so the batch solves
+	det = np.linalg.det(normal)
+	scale = normal[:, 0, 0] * normal[:, 1, 1] * counts
+	fit_ok = (counts >= 3) & (np.abs(det) > 1e-9 * scale)
+	normal[~fit_ok] = np.eye(3)
+	rhs[~fit_ok] = 0
+	solution = np.linalg.solve(normal, rhs[:, :, np.newaxis])[:, :, 0]
+
+	# Center is (-D/2, -E/2) back in micrograph coordinates
+	center_x = np.round(mean_x - solution[:, 0]/2, 0)
+	center_y = np.round(mean_y - solution[:, 1]/2, 0)
+
+	# Radius is the mean distance of the clicks from the rounded center
+	distances = np.hypot(x - center_x[inverse], y - center_y[inverse])
+	radii = np.round(group_sum(distances) / counts, 0)
+
+	centers = np.stack((center_x, center_y), axis=1).astype(np.int64)
+	return labels, centers, radii.astype(np.int64), fit_ok
+
+
+def last_in_group(group):
+	"""
+	Returns the index of the last row of every group, ordered by sorted group label.
+	"""
+	labels, reverse_first = np.unique(group[::-1], return_index=True)
+	return len(group) - 1 - reverse_first
 
 
 def parse_star(inMcgs):
@@ -236,34 +313,6 @@ def get_constant_matrix(mcg_names):
 	return constant_container
 
 
-def infer_index(np_array):
-	# Defined pattern is binary string, list of two ints >1000, float <= 1, float <=1
-	for i in range(0, len(np_array[1])):
-		try:
-			np_array[1][i].decode("utf-8")
-			try:
-				a = len(np_array[1][i+1])
-				if np_array[1][i+2] < 1:
-					if np_array[1][i+3] < 1:
-						startInd = i
-						break
-			except:
-				pass
-		except:
-			pass
-	return startInd
-
-
-def find_mcg_name(query, np_array):
-	""" Return index of cs numpy array that contains the micrograph info"""
-	for i in range(0, len(np_array)):
-		try:
-			if query in str(np_array[i]):
-				return i
-		except:
-			pass
-
-
 def line_writer(x, y):
 	# Process x and y
 	padded_x = leftpad(x, 12)
@@ -334,6 +383,13 @@ def clean_large_numbers(inInt):
 if __name__ == "__main__":
 	if len(sys.argv) == 3:
 		main(sys.argv[1], sys.argv[2])
+	elif (len(sys.argv) == 4) and sys.argv[3].isdigit() and (int(sys.argv[3]) >= 3):
+		main(sys.argv[1], sys.argv[2], int(sys.argv[3]))
+	elif len(sys.argv) == 4:
+		print("Check usage: clicksPerVesicle must be a whole number of at least 3.")
+		exit(1)
 	else:
-		print("Check usage: python foo.py csparcJobID /path/to/your/cryosparc/particles/file.cs")
+		print("Check usage: python foo.py csparcJobID /path/to/your/cryosparc/particles/file.cs [clicksPerVesicle]")
+		print("       (pass a directory or quoted glob such as \"exports/*.cs\" to convert and merge many files)")
+		print("       (clicksPerVesicle groups clicks by count, default 3, for files without a vesicle id column)")
 		exit()
\ No newline at end of file
@@ -14,12 +14,12 @@ Fill MRCs with random noise between -20 and 20 (signed floats)
 
 import sys
 import numpy as np
-import json
 import os
 from os import listdir
 from os.path import isfile, join
 import random
 import mrcfile
+from vesicle_model import load_model
 
 
 def main(inModel):
@@ -29,14 +29,13 @@ def main(inModel):
 	else:
 		print("\nDetected a Fake_data folder in this directory.")
 
-	# Load the model as json
-	with open(inModel, "r") as f:
-		model_dict = json.load(f)
+	# Load the model (json or npz)
+	vesicle_model = load_model(inModel)
 
 	# Generate a fake image for each and save it
-	total_items = len(model_dict)
+	total_items = vesicle_model.n_micrographs()
 	counter = 1
-	for item in model_dict:
+	for item in vesicle_model.mcg_names.tolist():
 		if counter % 10 == 0:
 			print(str(counter)+" / "+str(total_items))
 		gen_fake_image(4092, 5760, 25, item)
@@ -6,25 +6,32 @@ merge_cs.py
 """
 
 
-import numpy as np
 import sys
-import shutil
-import os
+from cs_io import cs_header, iter_cs_chunks, create_cs, commit_cs, discard_cs
 
 
 def main(inList):
-	f = np.load(inList[0])
-	g = np.load(inList[1])
-	outList = np.concatenate((f, g))
-	if len(inList) > 2:
-		for i in range(2, len(inList)):
-			f = np.load(inList[i])
-			outList = np.concatenate((outList, f))
-
-	np.save("_temp.npy", outList)
-	shutil.copy2("_temp.npy", "merged_cs_out.cs")
-	os.remove("_temp.npy")
-	print(len(outList))
+	# Read the headers to size the output without loading any particles
+	headers = [cs_header(inCs) for inCs in inList]
+	for i in range(1, len(headers)):
+		if headers[i][0] != headers[0][0]:
+			print("Check inputs: "+inList[i]+" has different fields from "+inList[0]+".")
+			exit()
+	total_rows = sum([header[1] for header in headers])
+
+	# Stream every input into a preallocated output, one block at a time
+	outList = create_cs("merged_cs_out.cs", headers[0][0], total_rows)
+	row = 0
+	try:
+		for inCs in inList:
+			for start, block in iter_cs_chunks(inCs):
+				outList[row:row+len(block)] = block
+				row += len(block)
+	except BaseException:
+		discard_cs(outList)
+		raise
+	commit_cs(outList, "merged_cs_out.cs")
+	print(total_rows)
 
 
 def no_ext(inStr):
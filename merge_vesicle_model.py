@@ -6,8 +6,8 @@ Massachusetts General Hospital
 
 merge_vesicle_model.py
 
-Looks for a directory called "Vesicle_data" and merges all the models there into a 
-single model json file.  Outputs to ./Vesicle_data/vesicle_model_merged.json
+Looks for a directory called "Vesicle_data" and merges all the models there (.npz or .json) into a 
+single model file.  Outputs to ./Vesicle_data/vesicle_model_merged.npz
 
 
 """
@@ -17,8 +17,7 @@ import sys
 import os
 from os import listdir
 from os.path import isfile, join
-import numpy as np
-import json
+from vesicle_model import load_model, save_model, merge_models
 
 
 def main():
@@ -27,20 +26,31 @@ def main():
 		print("No Vesicle_data directory detected.  Exiting...")
 		exit()
 
-	# Get the existing model files
-	onlyfiles = [f for f in listdir("./Vesicle_data/") if (isfile(join("./Vesicle_data", f)) and f.endswith(".json"))]
+	# Get the existing model files, skipping any previous merge output
+	onlyfiles = [f for f in listdir("./Vesicle_data/") if (isfile(join("./Vesicle_data", f)) and (f.endswith(".npz") or f.endswith(".json")))]
+	onlyfiles = [f for f in onlyfiles if no_ext(f) != "vesicle_model_merged"]
 
-	# Load and merge them one by one
-	new_dict = {}
+	# Load them one by one and merge
+	models = []
 	for each_file in onlyfiles:
 		print(each_file)
-		with open("./Vesicle_data/"+each_file, "r") as f:
-			this_dict = json.load(f)
-			new_dict.update(this_dict)
-
-	# Dump new_dict
-	with open("./Vesicle_data/vesicle_model_merged.json", "w") as g:
-		json.dump(new_dict, g)
+		models.append(load_model("./Vesicle_data/"+each_file))
+	new_model = merge_models(models)
+
+	# Dump new_model
+	save_model(new_model, "./Vesicle_data/vesicle_model_merged.npz")
+
+
+def no_ext(inStr):
+	"""
+	Takes an input filename and returns a string with the file extension removed.
+	"""
+	prevPos = 0
+	currentPos = 0
+	while currentPos != -1:
+		prevPos = currentPos
+		currentPos = inStr.find(".", prevPos+1)
+	return inStr[0:prevPos]
 
 
 if __name__ == "__main__":
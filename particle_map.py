@@ -0,0 +1,205 @@
+"""
+
+particle_map.py
+
+Columnar particle-vesicle map.
+
+The json particle map is a dict keyed by particle id, holding x, y, ves_id, angle, r_eff, topology and ring
+for every procedural pick.  This module holds the same information as typed arrays, one entry per particle:
+ - uid (uint64, the cryosparc particle uid the pick was written with)
+ - x, y (float32, fraction of the micrograph width / height, as in the cs file)
+ - vesicle (int64, row in the ves_keys table)
+ - angle, r_eff (float32)
+ - topology (uint8 code into TOPOLOGIES; picks on inner rings are internal)
+ - ring (uint16, 0 for the outermost ring of a vesicle, counting inwards)
+plus the ves_keys table itself.  Maps written before rings were recorded load with every ring at 0.
+
+On disk the map is an uncompressed .npz, memory-mapped on load like the vesicle model.  Json maps are still
+read and written (floats are stored at float32 precision, so a json -> npz -> json round trip rounds x, y,
+angle and r_eff).
+
+Usage:
+	python particle_map.py inMap.json outMap.npz
+	python particle_map.py inMap.npz outMap.json
+	python particle_map.py inMap.npz outMap.npz --max-ring=N     (keep only rings 0..N)
+
+"""
+
+
+import sys
+import json
+import numpy as np
+from vesicle_model import npz_memmap
+
+
+# Topology names, indexed by the stored topology code
+TOPOLOGIES = ["external", "internal"]
+
+# Arrays stored in a .npz map
+MAP_ARRAYS = ["uid", "x", "y", "vesicle", "angle", "r_eff", "topology", "ring", "ves_keys"]
+
+
+def main(inMap, outMap, max_ring=None):
+	particle_map = load_map(inMap)
+	if max_ring is not None:
+		particle_map = particle_map.within_depth(max_ring)
+	save_map(particle_map, outMap)
+	print("Converted "+str(len(particle_map))+" particles to "+outMap)
+
+
+class ParticleMap:
+	"""
+	Particle-vesicle map stored as per-particle arrays plus a table of vesicle keys.
+	"""
+
+	def __init__(self, uid, x, y, vesicle, angle, r_eff, topology, ring, ves_keys):
+		self.uid = uid
+		self.x = x
+		self.y = y
+		self.vesicle = vesicle
+		self.angle = angle
+		self.r_eff = r_eff
+		self.topology = topology
+		self.ring = ring
+		self.ves_keys = ves_keys
+		self._uid_order = None
+
+	def __len__(self):
+		return len(self.uid)
+
+	def ves_id(self):
+		""" Returns the vesicle key of every particle. """
+		return np.asarray(self.ves_keys)[self.vesicle]
+
+	def find(self, uids):
+		"""
+		Returns the row of each particle uid, or -1 for uids not in the map.  The sort behind the lookup is
+		built on first use.
+		"""
+		uids = np.atleast_1d(np.asarray(uids, dtype=np.uint64))
+		if self._uid_order is None:
+			self._uid_order = np.argsort(self.uid, kind="stable")
+		sorted_uid = np.asarray(self.uid)[self._uid_order]
+		slot = np.searchsorted(sorted_uid, uids)
+		slot[slot == len(sorted_uid)] = 0
+		rows = np.full(len(uids), -1, dtype=np.int64)
+		if len(sorted_uid) > 0:
+			found = sorted_uid[slot] == uids
+			rows[found] = self._uid_order[slot[found]]
+		return rows
+
+	def select(self, rows):
+		""" Returns a new map holding only the given rows (index array or boolean mask). """
+		return ParticleMap(*[np.asarray(getattr(self, name))[rows] for name in MAP_ARRAYS[0:-1]], np.asarray(self.ves_keys))
+
+	def within_depth(self, max_ring):
+		""" Returns a new map holding only the picks on rings 0..max_ring of their vesicle. """
+		return self.select(np.asarray(self.ring) <= max_ring)
+
+	def to_dict(self):
+		""" Returns the map in the json layout. """
+		map_dict = {}
+		topology_names = np.asarray(TOPOLOGIES)[self.topology].tolist()
+		for uid, x, y, ves_id, angle, r_eff, topology, ring in zip(self.uid.tolist(), self.x.tolist(), self.y.tolist(), self.ves_id().tolist(), self.angle.tolist(), self.r_eff.tolist(), topology_names, self.ring.tolist()):
+			map_dict[uid] = {"x": x, "y": y, "ves_id": ves_id, "angle": angle, "r_eff": r_eff, "topology": topology, "ring": ring}
+		return map_dict
+
+
+def from_picks(picks, ves_keys):
+	"""
+	Builds a map from pick columns (see vesicle_procedural_pick.pick_engine), whose vesicle column indexes
+	ves_keys.  Picks carrying topology and ring columns keep them; otherwise every pick is external, on
+	ring 0.
+	"""
+	if "topology" in picks:
+		topology = np.asarray(picks["topology"], dtype=np.uint8)
+	else:
+		topology = np.zeros(len(picks["uid"]), dtype=np.uint8)
+	if "ring" in picks:
+		ring = np.asarray(picks["ring"], dtype=np.uint16)
+	else:
+		ring = np.zeros(len(picks["uid"]), dtype=np.uint16)
+	return ParticleMap(
+		np.asarray(picks["uid"], dtype=np.uint64),
+		np.asarray(picks["x_frac"], dtype=np.float32),
+		np.asarray(picks["y_frac"], dtype=np.float32),
+		np.asarray(picks["vesicle"], dtype=np.int64),
+		np.asarray(picks["angle"], dtype=np.float32),
+		np.asarray(picks["r_eff"], dtype=np.float32),
+		topology,
+		ring,
+		np.asarray(ves_keys, dtype=str))
+
+
+def from_dict(map_dict):
+	"""
+	Builds a map from the json layout.  Particle ids may be ints or (as json leaves them) strings.  Entries
+	without a ring (older maps) are put on ring 0.
+	"""
+	uid, x, y, ves_id, angle, r_eff, topology, ring = [], [], [], [], [], [], [], []
+	for particle in map_dict:
+		entry = map_dict[particle]
+		uid.append(int(particle))
+		x.append(entry["x"])
+		y.append(entry["y"])
+		ves_id.append(str(entry["ves_id"]))
+		angle.append(entry["angle"])
+		r_eff.append(entry["r_eff"])
+		topology.append(TOPOLOGIES.index(entry["topology"]))
+		ring.append(entry.get("ring", 0))
+	ves_keys, vesicle = np.unique(np.asarray(ves_id, dtype=str), return_inverse=True)
+
+	return ParticleMap(
+		np.asarray(uid, dtype=np.uint64),
+		np.asarray(x, dtype=np.float32),
+		np.asarray(y, dtype=np.float32),
+		vesicle.reshape(-1).astype(np.int64),
+		np.asarray(angle, dtype=np.float32),
+		np.asarray(r_eff, dtype=np.float32),
+		np.asarray(topology, dtype=np.uint8),
+		np.asarray(ring, dtype=np.uint16),
+		ves_keys)
+
+
+def concatenate_maps(maps, ves_keys):
+	"""
+	Joins maps that all index the same ves_keys table (e.g. batches of picks from one vesicle model).
+	"""
+	empty = from_picks({"uid": [], "x_frac": [], "y_frac": [], "vesicle": [], "angle": [], "r_eff": []}, ves_keys)
+	return ParticleMap(*[np.concatenate([getattr(particle_map, name) for particle_map in [empty] + maps]) for name in MAP_ARRAYS[0:-1]], empty.ves_keys)
+
+
+def load_map(inMap):
+	"""
+	Loads a particle map from .npz (memory-mapped) or json.
+	"""
+	if inMap.endswith(".npz"):
+		arrays = npz_memmap(inMap)
+		if "ring" not in arrays:
+			arrays["ring"] = np.zeros(len(arrays["uid"]), dtype=np.uint16)
+		return ParticleMap(*[arrays[name] for name in MAP_ARRAYS])
+	with open(inMap, "r") as f:
+		return from_dict(json.load(f))
+
+
+def save_map(particle_map, outMap):
+	"""
+	Writes a particle map as an uncompressed .npz, or as json if outMap ends in .json.
+	"""
+	if outMap.endswith(".json"):
+		with open(outMap, "w") as g:
+			json.dump(particle_map.to_dict(), g)
+	else:
+		arrays = {name: np.asarray(getattr(particle_map, name)) for name in MAP_ARRAYS}
+		with open(outMap, "wb") as g:
+			np.savez(g, **arrays)
+
+
+if __name__ == "__main__":
+	if len(sys.argv) == 3:
+		main(sys.argv[1], sys.argv[2])
+	elif (len(sys.argv) == 4) and sys.argv[3].startswith("--max-ring=") and sys.argv[3][11:].isdigit():
+		main(sys.argv[1], sys.argv[2], int(sys.argv[3][11:]))
+	else:
+		print("Check usage: python foo.py inMap outMap [--max-ring=N]")
+		exit()
@@ -0,0 +1,221 @@
+"""
+
+pick_stats.py
+
+Streaming statistics for vesicles and procedural picks.
+
+A PickStats accumulates, batch by batch:
+ - a histogram of vesicle diameters (nm), in fixed-width bins starting at zero
+ - pick counts per vesicle and per micrograph
+using np.bincount, so memory grows with the number of bins, vesicles and micrographs but not with the
+number of picks.  Results export as json or csv, and a diameter histogram png is only drawn when asked
+for; matplotlib is imported at that point, on the non-interactive Agg backend.
+
+Usage:
+	python pick_stats.py vesicleModel.npz pxSize [particleMap.npz] [--out=stats.json] [--png]
+
+"""
+
+
+import sys
+import json
+import numpy as np
+from vesicle_model import load_model
+from particle_map import load_map
+
+
+# Width of the diameter histogram bins (nm)
+DIAMETER_BIN_NM = 2.0
+
+# Particle map rows counted per batch
+STATS_BATCH = 1000000
+
+
+def main(inModel, px_size, inMap, outJson, png):
+	vesicle_model = load_model(inModel)
+	particle_map = None
+	if inMap is not None:
+		particle_map = load_map(inMap)
+	stats = model_stats(vesicle_model, px_size, particle_map)
+	stats.write_json(outJson)
+	stats.write_csv(no_ext(outJson))
+	if png == True:
+		stats.plot_diameters(no_ext(outJson)+"_distribution.png")
+	print("Statistics written to "+outJson)
+
+
+class PickStats:
+	"""
+	Incremental diameter histogram and pick counts.  n_vesicles and n_mcg size the count arrays up front;
+	they grow if larger indexes turn up.
+	"""
+
+	def __init__(self, px_size, n_vesicles=0, n_mcg=0, bin_nm=DIAMETER_BIN_NM):
+		self.px_size = px_size
+		self.bin_nm = bin_nm
+		self.diameter_counts = np.zeros(0, dtype=np.int64)
+		self.picks_per_vesicle = np.zeros(n_vesicles, dtype=np.int64)
+		self.picks_per_mcg = np.zeros(n_mcg, dtype=np.int64)
+		self.n_vesicles_seen = 0
+
+	def add_vesicles(self, radii_px):
+		""" Adds a batch of vesicle radii (px) to the diameter histogram. """
+		diameter_nm = 2 * self.px_size * np.asarray(radii_px, dtype=np.float64) / 10
+		bins = np.floor(np.clip(diameter_nm, 0, None) / self.bin_nm).astype(np.int64)
+		self.diameter_counts = add_counts(self.diameter_counts, bins)
+		self.n_vesicles_seen += len(bins)
+
+	def add_picks(self, vesicle, mcg):
+		""" Counts a batch of picks, given the vesicle and micrograph index of each. """
+		self.picks_per_vesicle = add_counts(self.picks_per_vesicle, np.asarray(vesicle, dtype=np.int64))
+		self.picks_per_mcg = add_counts(self.picks_per_mcg, np.asarray(mcg, dtype=np.int64))
+
+	def add_map(self, particle_map, vesicle_model, vesicles=None):
+		"""
+		Counts the picks of a particle map, in batches of STATS_BATCH rows.  Picks are counted against model
+		rows, or with vesicles (an array of model rows) against positions in that array, leaving out picks on
+		any other vesicle.
+		"""
+		ves_rows = vesicle_rows(particle_map, vesicle_model)
+		ves_mcg = vesicle_model.mcg_index()
+		slot = np.arange(len(vesicle_model))
+		if vesicles is not None:
+			slot = np.full(len(vesicle_model), -1, dtype=np.int64)
+			slot[np.asarray(vesicles)] = np.arange(len(vesicles))
+		for start in range(0, len(particle_map.vesicle), STATS_BATCH):
+			model_row = ves_rows[np.asarray(particle_map.vesicle[start:start+STATS_BATCH])]
+			counted = slot[model_row] >= 0
+			self.add_picks(slot[model_row][counted], ves_mcg[model_row][counted])
+
+	def diameter_edges(self):
+		""" Bin edges (nm) of the diameter histogram. """
+		return np.arange(len(self.diameter_counts) + 1) * self.bin_nm
+
+	def to_dict(self):
+		""" Summary in the json layout. """
+		per_vesicle = self.picks_per_vesicle
+		return {
+			"px_size_A": self.px_size,
+			"vesicles": int(self.n_vesicles_seen),
+			"picks": int(per_vesicle.sum()),
+			"diameter_nm": {
+				"bin_edges": self.diameter_edges().tolist(),
+				"counts": self.diameter_counts.tolist(),
+			},
+			"picks_per_vesicle": {
+				"mean": round(float(per_vesicle.mean()), 3) if len(per_vesicle) > 0 else 0,
+				"max": int(per_vesicle.max()) if len(per_vesicle) > 0 else 0,
+				"histogram": np.bincount(per_vesicle).tolist(),
+			},
+			"picks_per_micrograph": self.picks_per_mcg.tolist(),
+		}
+
+	def write_json(self, outJson):
+		with open(outJson, "w") as g:
+			json.dump(self.to_dict(), g, indent=1)
+
+	def write_csv(self, prefix):
+		"""
+		Writes <prefix>_diameters.csv (bin start, bin end, vesicles), <prefix>_picks_per_vesicle.csv
+		(picks, vesicles with that many) and <prefix>_picks_per_micrograph.csv (micrograph index, picks).
+		"""
+		edges = self.diameter_edges()
+		with open(prefix+"_diameters.csv", "w") as g:
+			g.write("diameter_nm_from,diameter_nm_to,vesicles\n")
+			for i in range(0, len(self.diameter_counts)):
+				g.write(str(edges[i])+","+str(edges[i+1])+","+str(self.diameter_counts[i])+"\n")
+		with open(prefix+"_picks_per_vesicle.csv", "w") as g:
+			g.write("picks,vesicles\n")
+			for picks, vesicles in enumerate(np.bincount(self.picks_per_vesicle).tolist()):
+				g.write(str(picks)+","+str(vesicles)+"\n")
+		with open(prefix+"_picks_per_micrograph.csv", "w") as g:
+			g.write("micrograph,picks\n")
+			for mcg, picks in enumerate(self.picks_per_mcg.tolist()):
+				g.write(str(mcg)+","+str(picks)+"\n")
+
+	def plot_diameters(self, outPng):
+		""" Draws the diameter histogram to a png. """
+		import matplotlib
+		matplotlib.use("Agg")
+		from matplotlib import pyplot as plt
+		edges = self.diameter_edges()
+		filled = np.flatnonzero(self.diameter_counts)
+		plt.figure()
+		plt.bar(edges[0:-1], self.diameter_counts, width=self.bin_nm, align="edge")
+		if len(filled) > 0:
+			plt.xlim(edges[filled[0]], edges[filled[-1]+1])
+		plt.xlabel("Vesicle diameter (nm)")
+		plt.ylabel("frequency")
+		plt.savefig(outPng)
+		plt.close()
+
+
+def model_stats(vesicle_model, px_size, particle_map=None, vesicles=None):
+	"""
+	Statistics of a vesicle model: the diameters of its vesicles and, with a particle map, their picks per
+	vesicle and per micrograph.  vesicles (an array of model rows) limits both to a subset, e.g. the
+	vesicles a curated set of particles came from; picks_per_vesicle then follows the order of vesicles.
+	"""
+	if vesicles is None:
+		vesicles = np.arange(len(vesicle_model))
+	stats = PickStats(px_size, len(vesicles), len(vesicle_model.mcg_names))
+	stats.add_vesicles(np.asarray(vesicle_model.radius)[vesicles])
+	if particle_map is not None:
+		stats.add_map(particle_map, vesicle_model, vesicles)
+	return stats
+
+
+def add_counts(counts, index):
+	""" Adds the occurrences of every index to counts, growing it if needed. """
+	batch = np.bincount(index, minlength=len(counts))
+	batch[0:len(counts)] += counts
+	return batch
+
+
+def vesicle_rows(particle_map, vesicle_model):
+	"""
+	Vesicle model row of every vesicle key in a particle map.  A map picked from this model indexes the
+	model's own key table, so its vesicle index already is the model row and keys are not looked at;
+	any other map (e.g. one read back from json) is matched by key, which needs the model's keys to be
+	unique (merge_models keeps them so).
+	"""
+	model_keys = np.asarray(vesicle_model.ves_keys)
+	map_keys = np.asarray(particle_map.ves_keys)
+	if (len(map_keys) == len(model_keys)) and np.array_equal(map_keys, model_keys):
+		return np.arange(len(model_keys))
+	model_keys, first_rows, key_counts = np.unique(model_keys, return_index=True, return_counts=True)
+	slot = np.searchsorted(model_keys, map_keys)
+	slot[slot == len(model_keys)] = 0
+	missing = model_keys[slot] != map_keys
+	if np.count_nonzero(missing) > 0:
+		raise KeyError("vesicle model has no vesicle "+str(map_keys[missing][0]))
+	repeated = key_counts[slot] > 1
+	if np.count_nonzero(repeated) > 0:
+		raise KeyError("vesicle model has more than one vesicle "+str(map_keys[repeated][0])+", so picks cannot be matched to it by key")
+	return first_rows[slot]
+
+
+def no_ext(inStr):
+	"""
+	Takes an input filename and returns a string with the file extension removed.
+	"""
+	prevPos = 0
+	currentPos = 0
+	while currentPos != -1:
+		prevPos = currentPos
+		currentPos = inStr.find(".", prevPos+1)
+	return inStr[0:prevPos]
+
+
+if __name__ == "__main__":
+	args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+	flags = [arg for arg in sys.argv[1:] if arg.startswith("--")]
+	if (len(args) in [2, 3]) and all([(arg == "--png") or arg.startswith("--out=") for arg in flags]):
+		outJson = no_ext(args[0])+"_stats.json"
+		for arg in flags:
+			if arg.startswith("--out="):
+				outJson = arg[6:]
+		main(args[0], float(args[1]), args[2] if len(args) == 3 else None, outJson, "--png" in flags)
+	else:
+		print("Check usage: python foo.py vesicleModel.npz pxSize [particleMap.npz] [--out=stats.json] [--png]")
+		exit()
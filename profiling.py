@@ -0,0 +1,160 @@
+"""
+
+profiling.py
+
+Opt-in per-stage instrumentation for the pipeline scripts.
+
+A StageProfiler records wall time, CPU time and peak resident memory for every named stage it wraps, and
+writes them as a json report.  With cprofile=True each stage is also run under cProfile and its stats are
+dumped next to the report (<report>_<stage>.prof, readable with pstats or snakeviz).
+
+Scripts take an optional profiler argument and wrap their stages with stage(profiler, name), which does
+nothing when profiler is None, so instrumented code costs nothing unless --profile is given.  Scripts that
+only learn where their outputs go from their params file set report_path once they have read it, before
+the first stage runs, so the report lands next to the outputs.
+
+"""
+
+
+import os
+import sys
+import json
+import time
+import platform
+import threading
+import contextlib
+import cProfile
+import resource
+
+
+# Command line flags that turn profiling on
+PROFILE_FLAGS = ["--profile", "--profile=cprofile"]
+
+
+class StageProfiler:
+	"""
+	Collects timing records for named stages, in the order they run.
+	"""
+
+	def __init__(self, report_path=None, cprofile=False):
+		self.report_path = report_path
+		self.cprofile = cprofile
+		self.records = []
+
+	@contextlib.contextmanager
+	def stage(self, name):
+		""" Context manager that times the enclosed block as one stage. """
+		sampler = RssSampler()
+		sampler.start()
+		profile = cProfile.Profile() if self.cprofile == True else None
+		wall_start = time.perf_counter()
+		cpu_start = time.process_time()
+		if profile is not None:
+			profile.enable()
+		try:
+			yield
+		finally:
+			if profile is not None:
+				profile.disable()
+			cpu_s = time.process_time() - cpu_start
+			wall_s = time.perf_counter() - wall_start
+			peak_rss = sampler.stop()
+			record = {
+				"stage": name,
+				"wall_s": round(wall_s, 4),
+				"cpu_s": round(cpu_s, 4),
+				"peak_rss_mb": round(peak_rss / 2**20, 1),
+			}
+			if profile is not None:
+				record["cprofile"] = no_ext(self.report_path)+"_"+name+".prof"
+				profile.dump_stats(record["cprofile"])
+			self.records.append(record)
+
+	def write_report(self):
+		""" Writes every stage record collected so far, plus run metadata, as json. """
+		report = {
+			"command": " ".join(sys.argv),
+			"python": platform.python_version(),
+			"platform": platform.platform(),
+			"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+			"total_wall_s": round(sum([record["wall_s"] for record in self.records]), 4),
+			"stages": self.records,
+		}
+		with open(self.report_path, "w") as g:
+			json.dump(report, g, indent=1)
+		print("Profile written to "+self.report_path)
+
+
+def stage(profiler, name):
+	"""
+	Times the enclosed block as a stage of profiler, or does nothing if profiler is None.
+	"""
+	if profiler is None:
+		return contextlib.nullcontext()
+	return profiler.stage(name)
+
+
+def profiler_from_args(args, report_path=None):
+	"""
+	Builds a StageProfiler if the command line asks for one: --profile for timings, --profile=cprofile to
+	also dump cProfile stats per stage.  Returns None otherwise.  Scripts check their flags against
+	PROFILE_FLAGS first, so a mistyped --profile= value is a usage error rather than a run without
+	profiling.
+	"""
+	if "--profile" in args:
+		return StageProfiler(report_path)
+	if "--profile=cprofile" in args:
+		return StageProfiler(report_path, cprofile=True)
+	return None
+
+
+class RssSampler:
+	"""
+	Tracks the peak resident set size of this process between start() and stop() by polling
+	/proc/self/statm from a background thread.  Falls back to the process high-water mark.
+	"""
+
+	def __init__(self, interval=0.005):
+		self.interval = interval
+		self.peak = 0
+		self._stop = threading.Event()
+		self._thread = threading.Thread(target=self._poll, daemon=True)
+
+	def _poll(self):
+		while True:
+			self.peak = max(self.peak, current_rss())
+			if self._stop.wait(self.interval):
+				break
+
+	def start(self):
+		self.peak = current_rss()
+		self._thread.start()
+
+	def stop(self):
+		self._stop.set()
+		self._thread.join()
+		self.peak = max(self.peak, current_rss())
+		return self.peak
+
+
+def current_rss():
+	""" Current resident set size in bytes. """
+	try:
+		with open("/proc/self/statm", "r") as f:
+			return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+	except (OSError, ValueError):
+		# ru_maxrss is in kB on Linux and bytes on macOS
+		peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+		return peak if sys.platform == "darwin" else peak * 1024
+
+
+def no_ext(inStr):
+	"""
+	Takes an input filename and returns a string with the file extension removed.
+	"""
+	prevPos = 0
+	currentPos = 0
+	while currentPos != -1:
+		prevPos = currentPos
+		currentPos = inStr.find(".", prevPos+1)
+	return inStr[0:prevPos]
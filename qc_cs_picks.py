@@ -17,13 +17,15 @@ from the problem images.
 
 """
 
-import os
 import sys
-import pdfplumber
 import numpy as np
+from cs_io import cs_column, micrograph_names, micrograph_keys, cs_header, iter_cs_chunks, create_cs, commit_cs, discard_cs
 
 
 def main(inPdf, inCs, csJobID):
+	# Imported here so write_subset can be used without pdfplumber installed
+	import pdfplumber
+
 	# Load the pdf file and extract text
 	pdf = pdfplumber.open(inPdf)
 	pages = pdf.pages[:]
@@ -73,64 +75,39 @@ def main(inPdf, inCs, csJobID):
 
 	# Everything is working to this point
 	# Next, need to go through the cryosparc array and remove particles for those images.
-	# Read in the cs file as a np array
-	f = np.load(inCs)
-
-	# Get the starting index for the particle location info
-	start_index = infer_index(f)
-
-	# Get the corresponding micrograph name
-	mcg_index = find_mcg_name(csJobID, f[0])
-
-	# Nested for loop (O(mn)...) to eliminate bad items
-	clean_particle_catcher = []
-
-	for i in range(0, len(f)): #THIS IS WHERE THE LOGIC IS FAILING, EVERYTHING ELSE WORKS STRUCTURALLY
-		is_problem = False
-		# Get the key value for comparison
-		working_name = last_slash(f[i][start_index].decode("ascii"))[0:last_slash(f[i][start_index].decode("ascii")).find("_")]
-		key_val = int(working_name)
-		if key_val in all_keys:
-			clean_particle_catcher.append(0)
-		else:
-			clean_particle_catcher.append(1)
-	
-	# Regenerate a new array using just the "keep" particles
-	mask = np.asarray(clean_particle_catcher)
-	clean_particles = f[mask.astype(bool)]
-
-	# Write out
-	np.save("_temp.npy", clean_particles)
-	os.rename("_temp.npy", no_ext(inCs)+"_particleSubset.cs")
+	write_subset(inCs, no_ext(inCs)+"_particleSubset.cs", all_keys)
 	print("...done.  Wrote out bad problem micrographs and a subset particle file.")
 	
 
-def infer_index(np_array):
-	# Defined pattern is binary string, list of two ints >1000, float <= 1, float <=1
-	for i in range(0, len(np_array[1])):
-		try:
-			np_array[1][i].decode("utf-8")
-			try:
-				a = len(np_array[1][i+1])
-				if np_array[1][i+2] < 1:
-					if np_array[1][i+3] < 1:
-						startInd = i
-						break
-			except:
-				pass
-		except:
-			pass
-	return startInd
-
-
-def find_mcg_name(query, np_array):
-	""" Return index of cs numpy array that contains the micrograph info"""
-	for i in range(0, len(np_array)):
-		try:
-			if query in str(np_array[i]):
-				return i
-		except:
-			pass
+def write_subset(inCs, outCs, problem_keys):
+	"""
+	Writes the particles of inCs that are not on a problem micrograph (by micrograph uid key) to outCs,
+	keeping their order.  Returns the number of particles kept.
+	"""
+	# Stream the cs file block by block, flagging particles that sit on a problem micrograph.
+	# Each block decodes its micrograph paths only once.
+	problem_keys = np.asarray(problem_keys, dtype=np.uint64)
+	keep_masks = [np.zeros(0, dtype=bool)]
+	for start, block in iter_cs_chunks(inCs):
+		mcg_names, mcg_inverse = micrograph_names(cs_column(block, "mcg_path"))
+		is_problem = np.isin(micrograph_keys(mcg_names), problem_keys)
+		keep_masks.append(~is_problem[mcg_inverse])
+	keep_mask = np.concatenate(keep_masks)
+
+	# Regenerate a new array using just the "keep" particles, written straight into a preallocated output
+	cs_dtype, n_rows, offset = cs_header(inCs)
+	clean_particles = create_cs(outCs, cs_dtype, int(np.count_nonzero(keep_mask)))
+	row = 0
+	try:
+		for start, block in iter_cs_chunks(inCs):
+			keep_block = block[keep_mask[start:start+len(block)]]
+			clean_particles[row:row+len(keep_block)] = keep_block
+			row += len(keep_block)
+	except BaseException:
+		discard_cs(clean_particles)
+		raise
+	commit_cs(clean_particles, outCs)
+	return row
 
 
 def qc_pdf_line(inLine):
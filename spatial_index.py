@@ -0,0 +1,232 @@
+"""
+
+spatial_index.py
+
+Uniform-grid spatial index over points that live on micrographs.
+
+Points are bucketed into square cells keyed by (micrograph, cell x, cell y), and the buckets are stored as
+one sorted array, so building the index is a single sort and a query only visits the cells that overlap
+its search radius.  Queries are batched: pass arrays of query points and get back arrays of matches.
+Pick the cell size close to the typical search radius.
+
+"""
+
+
+import numpy as np
+
+
+# Cell coordinates are packed into one int64 key as group | cell x | cell y, CELL_BITS bits per axis
+CELL_BITS = 20
+CELL_BIAS = 1 << (CELL_BITS - 1)
+
+# Widest search (in cells) nearest() attempts on the grid before scanning whole groups
+MAX_GRID_REACH = 4
+
+# Vectorized rounds mutual_best_matches runs before settling the remaining pairs one at a time
+MUTUAL_ROUNDS = 8
+
+
+class GridIndex:
+	"""
+	Spatial index over points (x, y) with an optional integer group (e.g. micrograph index) per point.
+	Points in different groups never match each other.
+	"""
+
+	def __init__(self, x, y, group=None, cell_size=1.0):
+		self.x = np.asarray(x, dtype=np.float64)
+		self.y = np.asarray(y, dtype=np.float64)
+		if group is None:
+			group = np.zeros(len(self.x), dtype=np.int64)
+		self.group = np.asarray(group, dtype=np.int64)
+		self.cell_size = float(cell_size)
+
+		# Sort the points by cell, and keep the start and length of every occupied cell
+		keys = self._cell_keys(self.x, self.y, self.group, 0, 0)
+		self.order = np.argsort(keys, kind="stable")
+		self.cell_ids, self.cell_starts, self.cell_counts = np.unique(keys[self.order], return_index=True, return_counts=True)
+
+	def __len__(self):
+		return len(self.x)
+
+	def _cell_keys(self, x, y, group, dx, dy):
+		cell_x = np.floor(x / self.cell_size).astype(np.int64) + dx + CELL_BIAS
+		cell_y = np.floor(y / self.cell_size).astype(np.int64) + dy + CELL_BIAS
+		return (group << (2*CELL_BITS)) | (cell_x << CELL_BITS) | cell_y
+
+	def query_radius(self, qx, qy, radius, qgroup=None):
+		"""
+		Finds every indexed point within radius of each query point (and in the same group).  Returns
+		parallel arrays (query index, point index, distance).
+		"""
+		qx = np.atleast_1d(np.asarray(qx, dtype=np.float64))
+		qy = np.atleast_1d(np.asarray(qy, dtype=np.float64))
+		if qgroup is None:
+			qgroup = np.zeros(len(qx), dtype=np.int64)
+		qgroup = np.atleast_1d(np.asarray(qgroup, dtype=np.int64))
+		query_ids = np.arange(len(qx))
+		if len(self.cell_ids) == 0:
+			return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0)
+
+		# Visit every cell that overlaps the search disc
+		reach = int(np.ceil(radius / self.cell_size))
+		found_q, found_p = [], []
+		for dx in range(-reach, reach+1):
+			for dy in range(-reach, reach+1):
+				keys = self._cell_keys(qx, qy, qgroup, dx, dy)
+				slot = np.searchsorted(self.cell_ids, keys)
+				slot[slot == len(self.cell_ids)] = 0
+				hit = self.cell_ids[slot] == keys
+				if np.count_nonzero(hit) == 0:
+					continue
+
+				# Expand each hit cell into the points it holds
+				starts = self.cell_starts[slot[hit]]
+				counts = self.cell_counts[slot[hit]]
+				within = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+				found_q.append(np.repeat(query_ids[hit], counts))
+				found_p.append(self.order[np.repeat(starts, counts) + within])
+
+		if len(found_q) == 0:
+			return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0)
+		query_index = np.concatenate(found_q)
+		point_index = np.concatenate(found_p)
+		distance = np.hypot(self.x[point_index] - qx[query_index], self.y[point_index] - qy[query_index])
+		keep = distance <= radius
+		return query_index[keep], point_index[keep], distance[keep]
+
+	def cell_point(self, qx, qy, qgroup=None):
+		"""
+		Hash lookup of the cell holding each query point.  Returns the index of the point that cell holds,
+		or -1 where the cell is empty or holds more than one point.
+		"""
+		qx = np.atleast_1d(np.asarray(qx, dtype=np.float64))
+		qy = np.atleast_1d(np.asarray(qy, dtype=np.float64))
+		if qgroup is None:
+			qgroup = np.zeros(len(qx), dtype=np.int64)
+		qgroup = np.atleast_1d(np.asarray(qgroup, dtype=np.int64))
+		point = np.full(len(qx), -1, dtype=np.int64)
+		if len(self.cell_ids) == 0:
+			return point
+
+		keys = self._cell_keys(qx, qy, qgroup, 0, 0)
+		slot = np.searchsorted(self.cell_ids, keys)
+		slot[slot == len(self.cell_ids)] = 0
+		hit = (self.cell_ids[slot] == keys) & (self.cell_counts[slot] == 1)
+		point[hit] = self.order[self.cell_starts[slot[hit]]]
+		return point
+
+	def nearest(self, qx, qy, qgroup=None, max_dist=None):
+		"""
+		Finds the nearest indexed point to each query point (in the same group).  Returns (point index,
+		distance), with -1 and inf where nothing lies within max_dist.  Without max_dist the grid search
+		widens a few times, then falls back to scanning the query's whole group.
+		"""
+		qx = np.atleast_1d(np.asarray(qx, dtype=np.float64))
+		qy = np.atleast_1d(np.asarray(qy, dtype=np.float64))
+		if qgroup is None:
+			qgroup = np.zeros(len(qx), dtype=np.int64)
+		qgroup = np.atleast_1d(np.asarray(qgroup, dtype=np.int64))
+		best_point = np.full(len(qx), -1, dtype=np.int64)
+		best_dist = np.full(len(qx), np.inf)
+		if len(self) == 0:
+			return best_point, best_dist
+
+		if max_dist is not None:
+			self._keep_closest(np.arange(len(qx)), self.query_radius(qx, qy, max_dist, qgroup), best_point, best_dist)
+			return best_point, best_dist
+
+		# Widen the grid search while it stays cheap
+		pending = np.arange(len(qx))
+		search = self.cell_size
+		while (len(pending) > 0) and (search <= MAX_GRID_REACH * self.cell_size):
+			self._keep_closest(pending, self.query_radius(qx[pending], qy[pending], search, qgroup[pending]), best_point, best_dist)
+			pending = pending[best_point[pending] < 0]
+			search = search * 2
+
+		# Anything still unanswered is far from every point; compare it against its whole group
+		if len(pending) > 0:
+			group_order = np.argsort(self.group, kind="stable")
+			groups, group_starts, group_counts = np.unique(self.group[group_order], return_index=True, return_counts=True)
+			slot = np.searchsorted(groups, qgroup[pending])
+			slot[slot == len(groups)] = 0
+			has_group = groups[slot] == qgroup[pending]
+			pending = pending[has_group]
+			starts = group_starts[slot[has_group]]
+			counts = group_counts[slot[has_group]]
+			within = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+			query_index = np.repeat(np.arange(len(pending)), counts)
+			point_index = group_order[np.repeat(starts, counts) + within]
+			distance = np.hypot(self.x[point_index] - qx[pending][query_index], self.y[point_index] - qy[pending][query_index])
+			self._keep_closest(pending, (query_index, point_index, distance), best_point, best_dist)
+
+		return best_point, best_dist
+
+	def _keep_closest(self, queries, matches, best_point, best_dist):
+		"""
+		Writes the closest match of each query (indices into queries) into best_point/best_dist.  Equally
+		close points go to the lowest point index.
+		"""
+		query_index, point_index, distance = matches
+		order = np.lexsort((point_index, distance, query_index))
+		query_index = query_index[order]
+		first = np.ones(len(query_index), dtype=bool)
+		first[1:] = query_index[1:] != query_index[:-1]
+		best_point[queries[query_index[first]]] = point_index[order][first]
+		best_dist[queries[query_index[first]]] = distance[order][first]
+
+
+def mutual_best_matches(query_index, point_index, distance):
+	"""
+	One-to-one matching over candidate (query, point, distance) pairs, as from query_radius: the greedy
+	matching that accepts pairs in order of distance (ties to the lowest query, then point, index) whenever
+	both sides are still free.
+
+	Most pairs settle in a few vectorized rounds, in which every free query and point proposes its closest
+	free partner and pairs that choose each other are kept.  Mutual choices are always pairs the greedy
+	matching accepts, but a chain of competing candidates (A's best is B's best is C's best ...) only
+	settles one link per round.  So after MUTUAL_ROUNDS rounds whatever is left is walked once in distance
+	order instead, keeping the worst case at O(P log P) for P pairs.  Returns the matched (query index, point
+	index, distance) arrays.
+	"""
+	order = np.lexsort((point_index, query_index, distance))
+	query_index = query_index[order]
+	point_index = point_index[order]
+	distance = distance[order]
+	matched_q, matched_p, matched_d = [], [], []
+	for i in range(0, MUTUAL_ROUNDS):
+		if len(query_index) == 0:
+			break
+
+		# With pairs sorted by distance, the first pair of each query (and of each point) is its best
+		query_first = np.zeros(len(query_index), dtype=bool)
+		query_first[np.unique(query_index, return_index=True)[1]] = True
+		point_first = np.zeros(len(point_index), dtype=bool)
+		point_first[np.unique(point_index, return_index=True)[1]] = True
+		mutual = query_first & point_first
+		matched_q.append(query_index[mutual])
+		matched_p.append(point_index[mutual])
+		matched_d.append(distance[mutual])
+
+		# Drop every pair touching a matched query or point
+		free = ~(np.isin(query_index, query_index[mutual]) | np.isin(point_index, point_index[mutual]))
+		query_index = query_index[free]
+		point_index = point_index[free]
+		distance = distance[free]
+
+	# Walk the rest in distance order, keeping every pair whose query and point are both still free
+	if len(query_index) > 0:
+		kept = np.zeros(len(query_index), dtype=bool)
+		taken_q = set()
+		taken_p = set()
+		for i, (q, p) in enumerate(zip(query_index.tolist(), point_index.tolist())):
+			if (q not in taken_q) and (p not in taken_p):
+				taken_q.add(q)
+				taken_p.add(p)
+				kept[i] = True
+		matched_q.append(query_index[kept])
+		matched_p.append(point_index[kept])
+		matched_d.append(distance[kept])
+
+	if len(matched_q) == 0:
+		return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0)
+	return np.concatenate(matched_q), np.concatenate(matched_p), np.concatenate(matched_d)
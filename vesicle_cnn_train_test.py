@@ -17,9 +17,9 @@ vesicle_cnn_train_test.py
 
 
 import sys
-import json
 import numpy as np
 import mrcfile
+from vesicle_model import load_model
 #import tensorflow as tf
 #from tensorflow import keras
 #import matplotlib.pyplot as plt
@@ -27,28 +27,21 @@ import mrcfile
 
 def main(inModel, inMcgDir, downscaleFactor, length, width):
 	# Load model
-	with open(inModel, "r") as f:
-		vesicle_model = json.load(f)
+	vesicle_model = load_model(inModel)
 
 	# Filter the model to remove anything where the circle center is out of bounds
 	x_min = 0
 	y_min = 0
 	x_max = length
 	y_max = width
-	filtered_dict = {}
-	for item in vesicle_model:
-		filtered_dict[item] = {}
-		counter = 0
-		for vesicle in vesicle_model[item]:
-			if center_on_mcg_check(vesicle_model[item][vesicle]["center"], x_min, x_max, y_min, y_max) == True:
-				counter += 1
-				filtered_dict[item][vesicle] = vesicle_model[item][vesicle]
-		if counter == 0:
-			del filtered_dict[item]
+	centers = np.asarray(vesicle_model.center)
+	on_mcg = (centers[:, 0] >= x_min) & (centers[:, 0] <= x_max) & (centers[:, 1] >= y_min) & (centers[:, 1] <= y_max)
+	filtered_model = vesicle_model.select(on_mcg)
 
 	# k
-	for item in filtered_dict:
+	for item in filtered_model.mcg_names:
 		# Generate an output nparray for 
+		pass
 
 
 def center_on_mcg_check(coords, x_min, x_max, y_min, y_max):
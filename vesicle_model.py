@@ -0,0 +1,309 @@
+"""
+
+vesicle_model.py
+
+Columnar vesicle model.
+
+The json vesicle model is a nested dict keyed by micrograph name, then by vesicle index, with mcg_h, mcg_w
+and box_size repeated on every vesicle.  This module holds the same information as flat arrays:
+ - a micrograph table (mcg_names, mcg_h, mcg_w)
+ - offsets into the vesicle arrays, one per micrograph plus an end marker
+ - per-vesicle ves_keys, center [x, y], radius and box_size
+
+Vesicles are stored grouped by micrograph, so the vesicles of micrograph i are rows offsets[i]:offsets[i+1].
+
+On disk the model is an uncompressed .npz.  Loading memory-maps every array straight out of the archive,
+so pulling out one micrograph only reads that micrograph's rows.  Json models are still read and written,
+and the conversion in both directions is lossless as long as each field is consistently int or float
+across vesicles (true of every model these scripts produce).
+
+Usage:
+	python vesicle_model.py inModel.json outModel.npz
+	python vesicle_model.py inModel.npz outModel.json
+
+"""
+
+
+import sys
+import json
+import struct
+import zipfile
+import numpy as np
+
+
+# Arrays stored in a .npz model
+MODEL_ARRAYS = ["mcg_names", "mcg_h", "mcg_w", "offsets", "ves_keys", "center", "radius", "box_size"]
+
+
+def main(inModel, outModel):
+	model = load_model(inModel)
+	save_model(model, outModel)
+	print("Converted "+str(len(model))+" vesicles on "+str(model.n_micrographs())+" micrographs to "+outModel)
+
+
+class VesicleModel:
+	"""
+	Vesicle model stored as a micrograph table plus per-vesicle arrays grouped by micrograph.
+	"""
+
+	def __init__(self, mcg_names, mcg_h, mcg_w, offsets, ves_keys, center, radius, box_size):
+		self.mcg_names = mcg_names
+		self.mcg_h = mcg_h
+		self.mcg_w = mcg_w
+		self.offsets = offsets
+		self.ves_keys = ves_keys
+		self.center = center
+		self.radius = radius
+		self.box_size = box_size
+		self._mcg_lookup = None
+
+	def __len__(self):
+		return len(self.radius)
+
+	def n_micrographs(self):
+		return len(self.mcg_names)
+
+	def mcg_lookup(self):
+		""" Dict from micrograph name to its row in the micrograph table, built on first use. """
+		if self._mcg_lookup is None:
+			self._mcg_lookup = {name: i for i, name in enumerate(self.mcg_names.tolist())}
+		return self._mcg_lookup
+
+	def mcg_index(self):
+		""" Returns the micrograph table row of every vesicle. """
+		return np.repeat(np.arange(self.n_micrographs()), np.diff(self.offsets))
+
+	def micrograph(self, mcg):
+		"""
+		Returns the vesicles of one micrograph, given by name or table row, as a dict of array slices.
+		"""
+		if isinstance(mcg, str):
+			mcg = self.mcg_lookup()[mcg]
+		start = int(self.offsets[mcg])
+		stop = int(self.offsets[mcg+1])
+		return {
+			"mcg": str(self.mcg_names[mcg]),
+			"mcg_h": int(self.mcg_h[mcg]),
+			"mcg_w": int(self.mcg_w[mcg]),
+			"ves_keys": self.ves_keys[start:stop],
+			"center": self.center[start:stop],
+			"radius": self.radius[start:stop],
+			"box_size": self.box_size[start:stop],
+		}
+
+	def select(self, mask):
+		"""
+		Returns a new model holding only the vesicles where mask is True.  Micrographs left without any
+		vesicles are dropped.
+		"""
+		mask = np.asarray(mask, dtype=bool)
+		counts = np.bincount(self.mcg_index()[mask], minlength=self.n_micrographs())
+		keep_mcg = counts > 0
+		return VesicleModel(
+			np.asarray(self.mcg_names)[keep_mcg],
+			np.asarray(self.mcg_h)[keep_mcg],
+			np.asarray(self.mcg_w)[keep_mcg],
+			np.concatenate(([0], np.cumsum(counts[keep_mcg]))).astype(np.int64),
+			np.asarray(self.ves_keys)[mask],
+			np.asarray(self.center)[mask],
+			np.asarray(self.radius)[mask],
+			np.asarray(self.box_size)[mask])
+
+	def to_dict(self):
+		""" Returns the model in the nested json layout. """
+		model_dict = {}
+		ves_keys = self.ves_keys.tolist()
+		center = self.center.tolist()
+		radius = self.radius.tolist()
+		box_size = self.box_size.tolist()
+		offsets = self.offsets.tolist()
+		mcg_h = self.mcg_h.tolist()
+		mcg_w = self.mcg_w.tolist()
+		for i, mcg in enumerate(self.mcg_names.tolist()):
+			model_dict[mcg] = {}
+			for j in range(offsets[i], offsets[i+1]):
+				model_dict[mcg][ves_keys[j]] = {}
+				model_dict[mcg][ves_keys[j]]["center"] = center[j]
+				model_dict[mcg][ves_keys[j]]["radius"] = radius[j]
+				model_dict[mcg][ves_keys[j]]["mcg_h"] = mcg_h[i]
+				model_dict[mcg][ves_keys[j]]["mcg_w"] = mcg_w[i]
+				model_dict[mcg][ves_keys[j]]["box_size"] = box_size[j]
+		return model_dict
+
+
+def from_arrays(mcg_names, mcg_h, mcg_w, ves_mcg, ves_keys, center, radius, box_size):
+	"""
+	Builds a model from per-vesicle arrays.  ves_mcg gives each vesicle's row in the (mcg_names, mcg_h,
+	mcg_w) table.  Micrographs are ordered by their first vesicle and keep their vesicles in input order;
+	micrographs without vesicles are left out.
+	"""
+	ves_mcg = np.asarray(ves_mcg, dtype=np.int64)
+	mcg_used, first_seen = np.unique(ves_mcg, return_index=True)
+	mcg_order = mcg_used[np.argsort(first_seen)]
+
+	# Renumber micrographs in order of appearance, then group the vesicles stably by micrograph
+	new_index = np.zeros(len(mcg_names), dtype=np.int64)
+	new_index[mcg_order] = np.arange(len(mcg_order))
+	ves_order = np.argsort(new_index[ves_mcg], kind="stable")
+	counts = np.bincount(new_index[ves_mcg], minlength=len(mcg_order))
+
+	return VesicleModel(
+		np.asarray(mcg_names, dtype=str)[mcg_order],
+		np.asarray(mcg_h, dtype=np.int64)[mcg_order],
+		np.asarray(mcg_w, dtype=np.int64)[mcg_order],
+		np.concatenate(([0], np.cumsum(counts))).astype(np.int64),
+		np.asarray(ves_keys, dtype=str)[ves_order],
+		np.asarray(center).reshape(-1, 2)[ves_order],
+		np.asarray(radius)[ves_order],
+		np.asarray(box_size)[ves_order])
+
+
+def from_dict(model_dict):
+	"""
+	Builds a model from the nested json layout.  Every vesicle on a micrograph must agree on mcg_h and
+	mcg_w.  Micrographs without vesicles are kept (with a size of 0) so the conversion is lossless.
+	"""
+	mcg_names, mcg_h, mcg_w, offsets = [], [], [], [0]
+	ves_keys, center, radius, box_size = [], [], [], []
+	for mcg in model_dict:
+		this_h = 0
+		this_w = 0
+		for n, vesicle in enumerate(model_dict[mcg]):
+			entry = model_dict[mcg][vesicle]
+			if n == 0:
+				this_h = entry["mcg_h"]
+				this_w = entry["mcg_w"]
+			elif (entry["mcg_h"] != this_h) or (entry["mcg_w"] != this_w):
+				raise ValueError("Vesicles on "+mcg+" disagree on the micrograph size.")
+			ves_keys.append(vesicle)
+			center.append(entry["center"])
+			radius.append(entry["radius"])
+			box_size.append(entry["box_size"])
+		mcg_names.append(mcg)
+		mcg_h.append(this_h)
+		mcg_w.append(this_w)
+		offsets.append(len(ves_keys))
+
+	return VesicleModel(
+		np.asarray(mcg_names, dtype=str),
+		np.asarray(mcg_h, dtype=np.int64),
+		np.asarray(mcg_w, dtype=np.int64),
+		np.asarray(offsets, dtype=np.int64),
+		np.asarray(ves_keys, dtype=str),
+		np.asarray(center).reshape(-1, 2),
+		np.asarray(radius),
+		np.asarray(box_size))
+
+
+def merge_models(models):
+	"""
+	Merges models with the same semantics as dict.update on the json layout: a micrograph that appears
+	in several models takes its vesicles from the last one, but keeps the position where it first appeared.
+	Keys are only unique within each micrograph of the json layout (and within each file cs_to_vesicle_model
+	converts), so if the merged keys collide every key is qualified with its micrograph row, as
+	"<row>_<key>", to keep them unique across the merged model.
+	"""
+	mcg_order = []
+	source = {}
+	for i, model in enumerate(models):
+		for j, mcg in enumerate(model.mcg_names.tolist()):
+			if mcg not in source:
+				mcg_order.append(mcg)
+			source[mcg] = (i, j)
+
+	mcg_h, mcg_w, counts, blocks = [], [], [], []
+	for mcg in mcg_order:
+		i, j = source[mcg]
+		start = int(models[i].offsets[j])
+		stop = int(models[i].offsets[j+1])
+		mcg_h.append(int(models[i].mcg_h[j]))
+		mcg_w.append(int(models[i].mcg_w[j]))
+		counts.append(stop - start)
+		blocks.append((i, start, stop))
+
+	def gather(attribute):
+		return np.concatenate([getattr(models[i], attribute)[start:stop] for i, start, stop in blocks])
+
+	if len(blocks) == 0:
+		return from_dict({})
+	ves_keys = np.asarray(gather("ves_keys"), dtype=str)
+	if len(np.unique(ves_keys)) != len(ves_keys):
+		ves_row = np.repeat(np.arange(len(mcg_order)), counts).astype(str)
+		ves_keys = np.char.add(np.char.add(ves_row, "_"), ves_keys)
+	return VesicleModel(
+		np.asarray(mcg_order, dtype=str),
+		np.asarray(mcg_h, dtype=np.int64),
+		np.asarray(mcg_w, dtype=np.int64),
+		np.concatenate(([0], np.cumsum(counts))).astype(np.int64),
+		ves_keys,
+		gather("center").reshape(-1, 2),
+		gather("radius"),
+		gather("box_size"))
+
+
+def load_model(inModel):
+	"""
+	Loads a vesicle model from .npz (memory-mapped) or json.
+	"""
+	if inModel.endswith(".npz"):
+		arrays = npz_memmap(inModel)
+		return VesicleModel(*[arrays[name] for name in MODEL_ARRAYS])
+	with open(inModel, "r") as f:
+		return from_dict(json.load(f))
+
+
+def save_model(model, outModel):
+	"""
+	Writes a vesicle model as an uncompressed .npz, or as json if outModel ends in .json.
+	"""
+	if outModel.endswith(".json"):
+		with open(outModel, "w") as g:
+			json.dump(model.to_dict(), g)
+	else:
+		arrays = {name: np.asarray(getattr(model, name)) for name in MODEL_ARRAYS}
+		with open(outModel, "wb") as g:
+			np.savez(g, **arrays)
+
+
+def npz_memmap(inNpz):
+	"""
+	Memory-maps every array of an uncompressed .npz archive read-only.  Compressed members can't be
+	mapped and are read normally.
+	"""
+	arrays = {}
+	with zipfile.ZipFile(inNpz) as archive:
+		members = archive.infolist()
+	with open(inNpz, "rb") as f:
+		for info in members:
+			name = info.filename[0:-4]
+			if (info.compress_type != zipfile.ZIP_STORED) or (info.file_size == 0):
+				with np.load(inNpz) as npz:
+					arrays[name] = npz[name]
+				continue
+
+			# Skip the zip local file header to reach the start of the stored .npy
+			f.seek(info.header_offset)
+			local_header = f.read(30)
+			name_len, extra_len = struct.unpack("<HH", local_header[26:30])
+			f.seek(info.header_offset + 30 + name_len + extra_len)
+
+			# Read the .npy header, then map the data that follows it
+			version = np.lib.format.read_magic(f)
+			if version == (1, 0):
+				shape, fortran_order, array_dtype = np.lib.format.read_array_header_1_0(f)
+			else:
+				shape, fortran_order, array_dtype = np.lib.format.read_array_header_2_0(f)
+			if int(np.prod(shape)) == 0:
+				arrays[name] = np.zeros(shape, dtype=array_dtype)
+			else:
+				order = "F" if fortran_order else "C"
+				arrays[name] = np.memmap(inNpz, dtype=array_dtype, mode="r", offset=f.tell(), shape=shape, order=order)
+	return arrays
+
+
+if __name__ == "__main__":
+	if len(sys.argv) == 3:
+		main(sys.argv[1], sys.argv[2])
+	else:
+		print("Check usage: python foo.py inModel outModel")
+		exit()
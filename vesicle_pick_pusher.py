@@ -11,122 +11,299 @@ Given:
 Output:
  - New set of particle picks with external-topology picks adjusted per user specs.
  - New particle-vesicle mapping dict with the r_eff values adjusted.
- - New histogram showing vesicle diameters for the particles in the subset.
+ - Statistics (as json) of the vesicle diameters and pick counts for the particles in the subset, and
+   optionally a histogram of the diameters.
+
+External picks are moved by the Adjust Radial Distance (outwards if positive, inwards if negative) along
+the angle they were picked at, and dropped if that takes them off the micrograph.  Curated particles that
+match no original pick can't be pushed, so they are left out of the pushed stack and written to
+<cs>_unmatched.cs instead.
+
+Outputs are written next to the curated cs file as <cs>_pushed.cs and <cs>_pushed_stats.json (diameter
+histogram and pick counts, see pick_stats.py), and the map to ./Particle_data/<cs>_pushed_particles.npz
+(add --json-map for the json layout).  Add --png to also plot the histogram to <cs>_pushed_distribution.png.
+
+The correlation of curated particles to original picks is cached next to the curated cs file as
+<cs>_correlation.npz, keyed by content hashes of the cs file, particle map and vesicle model, so re-runs
+with new push settings skip it.  It is recomputed automatically whenever any of those files change.
+
+Several distances can be tried in one run by listing them separated by ";" (e.g. -40;-20;20;40).  The
+inputs are loaded (memory-mapped) and correlated once, and every distance gets its own outputs, named
+<cs>_pushed_<distance>A.
 
 """
 
 
 import sys
 import os
-import shutil
-import json
+import hashlib
 import numpy as np 
-from matplotlib import pyplot as plt
-import math
-from math import pi, sin, cos
-from random import randint
+from cs_io import cs_column, resolve_fields, micrograph_names, micrograph_keys, load_cs
+from vesicle_model import load_model
+from particle_map import TOPOLOGIES, ParticleMap, load_map
+from vesicle_procedural_pick import write_picks, write_particle_map
+from pick_stats import model_stats, vesicle_rows
+from spatial_index import GridIndex, mutual_best_matches
 
 
-def main(params):
-	# Parse parameters file
-	inModel, inParticles, inCs, box_size_px, px_size, add_dist, set_overlap, push, csJobID = parse_params(params)
+# Curated particles are matched to original picks within this distance (px)
+MATCH_TOLERANCE_PX = 1.0
 
-	# Unit conversions
-	add_dist_px = add_dist / px_size
+# Rounds of re-searching hashed particles whose pick is contested, before searching all that are left
+MATCH_ROUNDS = 4
+
+
+def main(params, map_ext=".npz", png=False):
+	# Parse parameters file
+	inModel, inParticles, inCs, box_size_px, px_size, add_dists, set_overlap, push, csJobID = parse_params(params)
 
 	# Load vesicles from model
-	with open(inModel, "r") as f:
-		vesicle_model = json.load(f)
+	vesicle_model = load_model(inModel)
 
 	# Load particles from model
-	with open(inParticles, "r") as f:
-		particle_model = json.load(f)
+	particle_map = load_map(inParticles)
 
-	# Load cs file
-	cs_file = np.load(inCs)
+	# Load cs file, memory-mapped so rows are only paged in as they are used
+	cs_file = load_cs(inCs)
 
 	# Cryosparc has changed all my particle id's...
-	# Cross-correlate particle id's using pick X, Y, and Mcg designations
-	particle_corr_dict = id_correlate(csJobID, cs_file, particle_model, vesicle_model)
-
-	# Using correlations, load the associated info from the vesicle and particle models
-	for i in range(0, len(cs_file)):
-		pass
-		# Gather necessary info r_eff and angle info from particle model
-		# Do the trig to calculate the new pick coordinates
-		# Dynamically output into a new numpy array
-		# Write info out into a refreshed particle model
-
-	# Using the new particle and vesicle models, ouput of histogram 
-	# for what sized vesicles the particles are in
-
-
-def id_correlate(csJobID, cs_file, particle_model, vesicle_model):
-	""" CS is trying to drive me into an early grave.  I will not allow this. """
-	# Define a dictionary that maps new dictionary keys to old dictionary keys.
-	corr_dict = {}
-
-	# Create an inverted vesicle model
-	inv_ves_model = basic_invert_dict(vesicle_model)
-
-	# Get the starting index for the particle location info
-	start_index = infer_index(cs_file)
-	print(start_index)
-
-	# Get the corresponding micrograph name
-	mcg_index = find_mcg_name(csJobID, cs_file[0])
-	print(csJobID)
-
-	# For every particle, pull in the mcg name from the inverted vesicle model
-	for particle in particle_model:
-		vesicle_id = particle_model[particle]["ves_id"]
-		mcg = inv_ves_model[vesicle_id]
-		particle_model[particle]["mcg"] = mcg
-		particle_model[particle]["mcg_key"] = get_key(mcg)
-
-	# Particle model is now equipped to perform the correlation
-	counter = 0
-	good_counter = 0
-	for i in range(0, len(cs_file)):
-		this_entry = cs_file[i]
-		mcg_key = get_key(last_slash(this_entry[mcg_index].decode("ascii")))
-		x = this_entry[start_index+2]
-		y = this_entry[start_index+3]
-		new_id = this_entry[start_index]
-		
-		match_entries = []
-		for each_key in particle_model:
-			if particle_model[each_key]["mcg_key"] == mcg_key:
-				match_entries.append(each_key)
-		if len(match_entries) == 0:
-			counter += 1
-			print(counter, "NO PARTICLE ENTRIES", mcg_key, x, y)
-		else:
-			good_counter += 1
-			
-	print("GOOD PARTICLE", good_counter)
-
-
-
-
-
-	exit()
-
-
-def get_key(inStr):
-	work_str = last_slash(inStr)
-	under_loc = work_str.find("_")
-	return int(work_str[0:under_loc])
-
+	# Cross-correlate particle id's using pick X, Y, and Mcg designations, reusing a cached correlation
+	# of these exact inputs if there is one
+	map_rows = cached_correlate(csJobID, inCs, cs_file, inParticles, particle_map, inModel, vesicle_model)
+
+	# Particles without an original pick can't be pushed; keep them out of the pushed stacks, in a file of their own
+	unmatched = np.flatnonzero(map_rows < 0)
+	if len(unmatched) > 0:
+		write_picks(np.asarray(cs_file)[unmatched], no_ext(inCs)+"_unmatched.cs")
+		print(str(len(unmatched))+" unmatched particles left out of the pushed stacks, written to "+no_ext(inCs)+"_unmatched.cs")
+
+	# The correlation and pick geometry are shared by every push distance
+	setup = push_setup(cs_file, map_rows, particle_map, vesicle_model)
+	for add_dist in add_dists:
+		# Using correlations, push every external pick along its angle from the vesicle center
+		cs_pushed, pushed_map = push_picks(cs_file, setup, particle_map, add_dist / px_size, box_size_px)
+
+		# Write out the pushed particles and their particle-vesicle map, named by distance if there are several
+		prefix = no_ext(inCs)+"_pushed"
+		if len(add_dists) > 1:
+			prefix = prefix+"_"+("%g" % add_dist)+"A"
+		write_picks(cs_pushed, prefix+".cs")
+		write_particle_map(pushed_map, "./Particle_data/"+os.path.basename(prefix)+"_particles"+map_ext)
+		print("\t"+str(len(cs_pushed))+" particles output to "+prefix+".cs")
+
+		# Using the new particle and vesicle models, ouput statistics (and optionally a histogram)
+		# for what sized vesicles the particles are in
+		subset_vesicles = vesicle_rows(pushed_map, vesicle_model)[np.unique(pushed_map.vesicle)]
+		stats = model_stats(vesicle_model, px_size, pushed_map, subset_vesicles)
+		stats.write_json(prefix+"_stats.json")
+		if png == True:
+			stats.plot_diameters(prefix+"_distribution.png")
+
+
+def push_setup(cs_file, map_rows, particle_map, vesicle_model):
+	"""
+	Gathers what push_picks needs for every curated particle matched to a pick (map_rows from
+	id_correlate): its micrograph size, topology, vesicle center, current position, r_eff and the direction
+	it was picked at.  Computed once and shared by every push distance.
+	"""
+	rows = np.flatnonzero(map_rows >= 0)
+	picks = map_rows[rows]
+	mcg_shape = cs_column(cs_file, "mcg_shape")
+	mcg_h = mcg_shape[rows, 0].astype(np.float64)
+	mcg_w = mcg_shape[rows, 1].astype(np.float64)
+	center = np.asarray(vesicle_model.center)[vesicle_rows(particle_map, vesicle_model)[np.asarray(particle_map.vesicle)[picks]]]
+	angle = np.asarray(particle_map.angle, dtype=np.float64)[picks]
+	return {
+		"rows": rows,
+		"picks": picks,
+		"mcg_w": mcg_w,
+		"mcg_h": mcg_h,
+		"external": np.asarray(particle_map.topology)[picks] == TOPOLOGIES.index("external"),
+		"center_x": center[:, 0],
+		"center_y": center[:, 1],
+		"x": cs_column(cs_file, "x_frac")[rows] * mcg_w,
+		"y": cs_column(cs_file, "y_frac")[rows] * mcg_h,
+		"r_eff": np.asarray(particle_map.r_eff, dtype=np.float64)[picks],
+		"cos": np.cos(angle),
+		"sin": np.sin(angle),
+	}
+
+
+def push_picks(cs_file, setup, particle_map, push_px, box_size_px):
+	"""
+	Moves every curated particle matched to an external pick push_px further out along its angle from the
+	vesicle center (inwards for a negative push_px), all in one pass over arrays.  Pushed picks that end up
+	too close to the micrograph edge are dropped and internal picks are kept as they are.  Unmatched
+	particles are left out, since they can't be pushed (main writes them to their own file).  setup comes
+	from push_setup.
+
+	Returns the pushed particle array and its particle-vesicle map (matched particles only, under their
+	curated uids, with r_eff updated).
+	"""
+	rows = setup["rows"]
+	picks = setup["picks"]
+	mcg_w = setup["mcg_w"]
+	mcg_h = setup["mcg_h"]
+	external = setup["external"]
+
+	# New radius and position of every external pick, unchanged for internal ones
+	r_eff = setup["r_eff"] + np.where(external, push_px, 0.0)
+	x = np.where(external, setup["center_x"] + r_eff * setup["cos"], setup["x"])
+	y = np.where(external, setup["center_y"] + -1 * r_eff * setup["sin"], setup["y"])
+
+	# Re-apply the edge filter to the pushed picks
+	in_bounds = (x > 0) & (x < mcg_w - box_size_px) & (y > 0) & (y < mcg_h - box_size_px)
+	keep_matched = ~external | in_bounds
+	keep = np.zeros(len(cs_file), dtype=bool)
+	keep[rows[keep_matched]] = True
+	print("Pushed "+str(np.count_nonzero(external & in_bounds))+" external picks by "+str(round(push_px, 2))+" px; dropped "+str(np.count_nonzero(~keep_matched))+" pushed off the micrograph edge.")
+	print("\tKept "+str(np.count_nonzero(~external))+" internal picks in place; left out "+str(len(cs_file) - len(rows))+" unmatched particles.")
+
+	# Write the new coordinates into a copy of the kept rows
+	fields = resolve_fields(cs_file.dtype)
+	cs_pushed = np.asarray(cs_file)[keep]
+	out_rows = np.cumsum(keep)[rows[keep_matched]] - 1
+	cs_pushed[fields["x_frac"]][out_rows] = (x / mcg_w)[keep_matched]
+	cs_pushed[fields["y_frac"]][out_rows] = (y / mcg_h)[keep_matched]
+
+	# The matched particles, now under their curated uids
+	picks = picks[keep_matched]
+	pushed_map = ParticleMap(
+		cs_column(cs_pushed, "uid")[out_rows],
+		cs_column(cs_pushed, "x_frac")[out_rows],
+		cs_column(cs_pushed, "y_frac")[out_rows],
+		np.asarray(particle_map.vesicle)[picks],
+		np.asarray(particle_map.angle)[picks],
+		r_eff[keep_matched].astype(np.float32),
+		np.asarray(particle_map.topology)[picks],
+		np.asarray(particle_map.ring)[picks],
+		np.asarray(particle_map.ves_keys))
+	return cs_pushed, pushed_map
+
+
+def id_correlate(csJobID, cs_file, particle_map, vesicle_model):
+	"""
+	CS is trying to drive me into an early grave.  I will not allow this.
 
-def basic_invert_dict(inDict):
-	outDict = {}
-	for each_item in inDict.keys():
-		for sub_item in inDict[each_item].keys():
-			if sub_item not in outDict:
-				outDict[sub_item] = each_item
+	Matches curated particles one-to-one to original picks on the same micrograph, within
+	MATCH_TOLERANCE_PX, taking the closest pairs first.  Both sides are quantized to whole-pixel
+	(micrograph, x, y) keys, so a curated particle whose key belongs to exactly one nearby pick finds it in
+	a single hash lookup.  The rest (keys shared by several picks, or particles near a pixel boundary) get
+	every pick within tolerance from the grid index.  Prints the unmatched count and match distances.
 
-	return outDict
+	Returns the particle map row of every curated particle, or -1 where nothing matched; the original
+	particle ids are particle_map.uid at those rows.
+	"""
+	# Lay the original picks out as arrays in pixel coordinates, tagged with their micrograph
+	part_mcg = vesicle_model.mcg_index()[vesicle_rows(particle_map, vesicle_model)][particle_map.vesicle]
+	part_keys = micrograph_keys(vesicle_model.mcg_names.tolist())[part_mcg]
+	part_x = np.asarray(particle_map.x, dtype=np.float64) * np.asarray(vesicle_model.mcg_w)[part_mcg]
+	part_y = np.asarray(particle_map.y, dtype=np.float64) * np.asarray(vesicle_model.mcg_h)[part_mcg]
+
+	# Pull the micrograph keys and coordinates of the curated particles as columns
+	mcg_names, mcg_inverse = micrograph_names(cs_column(cs_file, "mcg_path"))
+	row_keys = micrograph_keys(mcg_names)[mcg_inverse]
+	mcg_shape = cs_column(cs_file, "mcg_shape")
+	row_x = cs_column(cs_file, "x_frac") * mcg_shape[:, 1]
+	row_y = cs_column(cs_file, "y_frac") * mcg_shape[:, 0]
+
+	# Micrograph keys are 64-bit uids; number them densely so they can group the spatial index.  Shifting
+	# by half a pixel makes the index cells whole-pixel bins centred on integer coordinates.
+	all_keys, dense_keys = np.unique(np.concatenate((part_keys, row_keys)), return_inverse=True)
+	dense_keys = dense_keys.reshape(-1)
+	part_group = dense_keys[0:len(part_keys)]
+	row_group = dense_keys[len(part_keys):]
+	pick_index = GridIndex(part_x + 0.5, part_y + 0.5, part_group, cell_size=1.0)
+
+	# Hash lookup first.  A pick alone in the particle's pixel is its closest pick if it lies nearer than the
+	# pixel's edges, since any other pick is beyond them; everything else gets every pick within tolerance.
+	hash_rows = pick_index.cell_point(row_x + 0.5, row_y + 0.5, row_group)
+	hashed = np.flatnonzero(hash_rows >= 0)
+	frac_x = (row_x[hashed] + 0.5) - np.floor(row_x[hashed] + 0.5)
+	frac_y = (row_y[hashed] + 0.5) - np.floor(row_y[hashed] + 0.5)
+	edge_dist = np.minimum(np.minimum(frac_x, 1 - frac_x), np.minimum(frac_y, 1 - frac_y))
+	hash_dist = np.hypot(part_x[hash_rows[hashed]] - row_x[hashed], part_y[hash_rows[hashed]] - row_y[hashed])
+	settled = (hash_dist < edge_dist) & (hash_dist <= MATCH_TOLERANCE_PX)
+	hashed, hash_dist = hashed[settled], hash_dist[settled]
+
+	# Match one-to-one: when curated particles compete for a pick the closest keeps it, and the others fall
+	# back to their next candidates.  A hashed particle only carries its closest pick, which it keeps as long
+	# as no other particle could claim it.  Hashed particles whose pick is claimed are searched in full, and
+	# their candidates can claim further picks; after MATCH_ROUNDS of this every hashed particle left is
+	# searched, so each particle is searched at most once.
+	claimed = np.bincount(hash_rows[hashed], minlength=len(part_x)) > 1
+	unhashed = np.ones(len(row_x), dtype=bool)
+	unhashed[hashed] = False
+	pending = np.flatnonzero(unhashed)
+	pairs = []
+	for i in range(0, MATCH_ROUNDS + 2):
+		# Pass 0 searches the unhashed particles, passes 1..MATCH_ROUNDS the contested ones, and the last pass
+		# every hashed particle still left
+		query, neighbour, distance = pick_index.query_radius(row_x[pending] + 0.5, row_y[pending] + 0.5, MATCH_TOLERANCE_PX, row_group[pending])
+		pairs.append((pending[query], neighbour, distance))
+		claimed[neighbour] = True
+		contested = claimed[hash_rows[hashed]] if i < MATCH_ROUNDS else np.ones(len(hashed), dtype=bool)
+		pending = hashed[contested]
+		hashed, hash_dist = hashed[~contested], hash_dist[~contested]
+		if len(pending) == 0:
+			break
+	pairs.append((hashed, hash_rows[hashed], hash_dist))
+	match_row, match_pick, match_dist = mutual_best_matches(*[np.concatenate(column) for column in zip(*pairs)])
+	map_rows = np.full(len(row_x), -1, dtype=np.int64)
+	map_rows[match_row] = match_pick
+	n_hashed = len(hashed)
+
+	# Report and return the correlations
+	n_matched = len(match_row)
+	print("Matched "+str(n_matched)+" / "+str(len(map_rows))+" curated particles to original picks ("+str(n_hashed)+" by pixel key); "+str(len(map_rows) - n_matched)+" unmatched.")
+	if n_matched > 0:
+		print("\tMatch distance (px): mean "+str(round(float(match_dist.mean()), 3))+", median "+str(round(float(np.median(match_dist)), 3))+", 95th percentile "+str(round(float(np.percentile(match_dist, 95)), 3))+", max "+str(round(float(match_dist.max()), 3)))
+	return map_rows
+
+
+def cached_correlate(csJobID, inCs, cs_file, inParticles, particle_map, inModel, vesicle_model):
+	"""
+	Runs id_correlate, or loads its result from the <cs>_correlation.npz sidecar if that was saved for the
+	same inputs.  The sidecar is keyed by content hashes of the cs file, the particle map and the vesicle
+	model (plus the match tolerance), so editing or replacing any of them invalidates it.
+	"""
+	cache_key = correlation_key([inCs, inParticles, inModel])
+	cache_path = no_ext(inCs)+"_correlation.npz"
+	if os.path.isfile(cache_path):
+		with np.load(cache_path) as cache:
+			if (str(cache["key"]) == cache_key) and (len(cache["map_rows"]) == len(cs_file)):
+				print("Loaded the particle correlation from "+cache_path)
+				return cache["map_rows"].astype(np.int64)
+
+	map_rows = id_correlate(csJobID, cs_file, particle_map, vesicle_model)
+
+	# Store the rows at the narrowest width that holds them, renamed into place once written
+	row_dtype = np.int32 if len(particle_map) < 2**31 else np.int64
+	temp_path = os.path.join(os.path.dirname(os.path.abspath(cache_path)), "."+os.path.basename(cache_path)+".tmp")
+	with open(temp_path, "wb") as g:
+		np.savez(g, key=np.asarray(cache_key), map_rows=map_rows.astype(row_dtype))
+	os.replace(temp_path, cache_path)
+	return map_rows
+
+
+def correlation_key(paths):
+	""" Combined content hash of the input files (and the match tolerance) of a correlation. """
+	digest = hashlib.blake2b(digest_size=20)
+	digest.update(("tolerance="+repr(MATCH_TOLERANCE_PX)).encode("ascii"))
+	for path in paths:
+		digest.update(file_digest(path).encode("ascii"))
+	return digest.hexdigest()
+
+
+def file_digest(path, block_size=2**24):
+	""" blake2b hash of a file's contents, read in blocks. """
+	digest = hashlib.blake2b(digest_size=20)
+	with open(path, "rb") as f:
+		block = f.read(block_size)
+		while len(block) > 0:
+			digest.update(block)
+			block = f.read(block_size)
+	return digest.hexdigest()
 
 
 def parse_params(params):
@@ -150,8 +327,8 @@ def parse_params(params):
 	if px_size < 0:
 		print("Check parameters: Pixel size must be a positive value.")
 		kill_flag = True
-	add_dist = float(items[5][1].strip())
-	if add_dist >= 0:
+	add_dists = [float(value.strip()) for value in items[5][1].split(";")]
+	if min(add_dists) >= 0:
 		push = True
 	else:
 		push = False
@@ -168,7 +345,7 @@ def parse_params(params):
 	length_list.append(len(inCs))
 	length_list.append(len(str(box_size_px)))
 	length_list.append(len(str(px_size)))
-	length_list.append(len(str(add_dist)))
+	length_list.append(len(add_dists))
 	length_list.append(len(str(set_overlap)))
 	length_list.append(len(job_id))
 	if min(length_list) == 0:
@@ -180,35 +357,7 @@ def parse_params(params):
 		print("Please fix the parameters file and try again: "+params)
 		exit()
 	else:
-		return inModel, inParticles, inCs, box_size_px, px_size, add_dist, set_overlap, push, job_id
-
-
-def infer_index(np_array):
-	# Defined pattern is binary string, list of two ints >1000, float <= 1, float <=1
-	for i in range(0, len(np_array[1])):
-		try:
-			np_array[1][i].decode("utf-8")
-			try:
-				a = len(np_array[1][i+1])
-				if np_array[1][i+2] < 1:
-					if np_array[1][i+3] < 1:
-						startInd = i
-						break
-			except:
-				pass
-		except:
-			pass
-	return startInd
-
-
-def find_mcg_name(query, np_array):
-	""" Return index of cs numpy array that contains the micrograph info"""
-	for i in range(0, len(np_array)):
-		try:
-			if query in str(np_array[i]):
-				return i
-		except:
-			pass
+		return inModel, inParticles, inCs, box_size_px, px_size, add_dists, set_overlap, push, job_id
 
 
 def last_slash(inStr):
@@ -248,8 +397,8 @@ def no_ext(inStr):
 
 
 if __name__ == "__main__":
-	if len(sys.argv) == 2:
-		main(sys.argv[1])
+	if (len(sys.argv) >= 2) and all([(arg in ["--json-map", "--png"]) for arg in sys.argv[2:]]):
+		main(sys.argv[1], ".json" if "--json-map" in sys.argv[2:] else ".npz", "--png" in sys.argv[2:])
 	else:
-		print("Check usage: python foo.py params.csv")
+		print("Check usage: python foo.py params.csv [--json-map] [--png]")
 		exit()
\ No newline at end of file
@@ -0,0 +1,163 @@
+"""
+
+vesicle_pipeline.py
+
+Runs vesicle conversion and procedural picking back to back, keeping the vesicle model, the picks and the
+particle-vesicle map in memory between the stages.  Only the final outputs are written:
+ - ./Vesicle_data/<manual picks>.npz        vesicle model (needed later by vesicle_pick_pusher.py)
+ - <manual picks>_particlesOut.cs            procedural picks for import into cryosparc
+ - ./Particle_data/<manual picks>_particles.npz     particle-vesicle map (.json with --json-map)
+ - <manual picks>_stats.json                 diameter histogram and pick counts (see pick_stats.py)
+ - <manual picks>_distribution.png           vesicle diameter histogram plot (only with --png)
+
+Given (params.csv):
+ - Manual vesicle picks (.cs, three clicks per vesicle)
+ - Input CS pick file to use as a template for output
+ - Box size (px)
+ - Pixel size (A/px)
+ - Distance from vesicle edge (A)
+ - Desired box overlap
+ - Internal picking (Y/N)
+ - Optionally, max cross-vesicle box overlap (0-1; blank = no limit)
+ - Optionally, clicks per vesicle, for manual picks without a vesicle id column (default 3; see
+   cs_to_vesicle_model.py)
+
+The stages are plain functions, so scripts can also import run_pipeline and use its return values directly.
+Add --profile to write per-stage timings to <manual picks>_profile.json, next to the other outputs
+(--profile=cprofile to also dump cProfile stats per stage).
+
+"""
+
+
+import sys
+import os
+from cs_to_vesicle_model import convert_cs
+from vesicle_procedural_pick import procedural_pick, write_picks, write_particle_map, parse_cross_overlap
+from vesicle_model import save_model
+from profiling import PROFILE_FLAGS, stage, profiler_from_args
+from pick_stats import model_stats
+
+
+def main(params, profiler=None, map_ext=".npz", png=False):
+	# Parse input parameters
+	inPicks, inCs, box_size_px, px_size, add_dist, set_overlap, set_internal_pick, max_cross_overlap, clicks_per_vesicle = parse_params(params)
+	prefix = no_ext(os.path.basename(inPicks))
+	if profiler is not None:
+		profiler.report_path = prefix+"_profile.json"
+
+	# Run every stage in memory
+	vesicle_model, cs_array, particle_map, all_radii_px = run_pipeline(inPicks, inCs, box_size_px, px_size, add_dist, set_overlap, set_internal_pick, clicks_per_vesicle, max_cross_overlap, profiler)
+
+	# Write out the final products
+	if os.path.isdir("./Vesicle_data") == False:
+		os.mkdir("./Vesicle_data")
+	with stage(profiler, "model_write"):
+		save_model(vesicle_model, "./Vesicle_data/"+prefix+".npz")
+	with stage(profiler, "cs_write"):
+		write_picks(cs_array, prefix+"_particlesOut.cs")
+	with stage(profiler, "map_write"):
+		write_particle_map(particle_map, "./Particle_data/"+prefix+"_particles"+map_ext)
+	with stage(profiler, "histogram"):
+		stats = model_stats(vesicle_model, px_size, particle_map)
+		stats.write_json(prefix+"_stats.json")
+		if png == True:
+			stats.plot_diameters(prefix+"_distribution.png")
+
+	print("\nProcessed "+str(len(vesicle_model))+" vesicles into "+str(len(cs_array))+" particles.")
+	print("\n...done.")
+	if profiler is not None:
+		profiler.write_report()
+
+
+def run_pipeline(manual_picks, cs_template, box_size_px, px_size, add_dist, set_overlap, set_internal_pick, clicks_per_vesicle=None, max_cross_overlap=None, profiler=None):
+	"""
+	Fits vesicles to the manual picks and procedurally picks them.  manual_picks and cs_template are cs
+	files or already-loaded cs arrays; add_dist is in Angstrom.  Clicks are grouped into vesicles by the
+	picks' vesicle id column, or clicks_per_vesicle (default 3) at a time if they have none.  If
+	max_cross_overlap is set, picks overlapping a neighbouring vesicle's picks by more than that fraction
+	are dropped.
+
+	Returns the vesicle model, the particle array, the particle-vesicle map and the list of vesicle radii
+	(px).
+	"""
+	print("Fitting vesicles...")
+	with stage(profiler, "vesicle_fit"):
+		vesicle_model = convert_cs(manual_picks, clicks_per_vesicle)
+
+	print("Picking...")
+	cs_array, particle_map, all_radii_px = procedural_pick(vesicle_model, cs_template, box_size_px, add_dist / px_size, set_overlap, set_internal_pick, max_cross_overlap, profiler)
+
+	return vesicle_model, cs_array, particle_map, all_radii_px
+
+
+def parse_params(params):
+	# Load and read csv input
+	kill_flag = False
+	with open(params, "r") as f:
+		lines = f.readlines()
+		items = []
+		for i in range(0, len(lines)):
+			items.append(lines[i].split(","))
+
+	# Item definitions
+	inPicks = items[0][1].strip()
+	inCs = items[1][1].strip()
+	box_size_px = int(items[2][1].strip())
+	if box_size_px < 0:
+		print("Check parameters: Box size must be a positive value.")
+		kill_flag = True
+	px_size = float(items[3][1].strip())
+	if px_size < 0:
+		print("Check parameters: Pixel size must be a positive value.")
+		kill_flag = True
+	add_dist = float(items[4][1].strip())
+	set_overlap = float(items[5][1].strip())
+	if (set_overlap > 1.0) or (set_overlap < 0.0):
+		print("Check parameters: Pick Box Overlap must be between 0 and 1.")
+		kill_flag = True
+	if items[6][1].strip() in ["Y", "y"]:
+		set_internal_pick = True
+	else:
+		set_internal_pick = False
+	max_cross_overlap = parse_cross_overlap(items)
+	if (max_cross_overlap is not None) and ((max_cross_overlap > 1.0) or (max_cross_overlap < 0.0)):
+		print("Check parameters: Max Cross-Vesicle Overlap must be between 0 and 1, or blank.")
+		kill_flag = True
+	clicks_per_vesicle = None
+	if (len(items) >= 9) and (len(items[8]) >= 2) and (items[8][1].strip() != ""):
+		clicks_per_vesicle = int(items[8][1].strip())
+		if clicks_per_vesicle < 3:
+			print("Check parameters: Clicks Per Vesicle must be at least 3, or blank.")
+			kill_flag = True
+
+	# Make sure all params are actually populated
+	if min([len(inPicks), len(inCs)]) == 0:
+		print("At least one of the required parameters is blank!")
+		kill_flag = True
+
+	# Return or kill
+	if kill_flag == True:
+		print("Please fix the parameters file and try again: "+params)
+		exit()
+	else:
+		return inPicks, inCs, box_size_px, px_size, add_dist, set_overlap, set_internal_pick, max_cross_overlap, clicks_per_vesicle
+
+
+def no_ext(inStr):
+	"""
+	Takes an input filename and returns a string with the file extension removed.
+	"""
+	prevPos = 0
+	currentPos = 0
+	while currentPos != -1:
+		prevPos = currentPos
+		currentPos = inStr.find(".", prevPos+1)
+	return inStr[0:prevPos]
+
+
+if __name__ == "__main__":
+	if (len(sys.argv) >= 2) and all([((arg in PROFILE_FLAGS) or (arg in ["--json-map", "--png"])) for arg in sys.argv[2:]]):
+		main(sys.argv[1], profiler_from_args(sys.argv[2:]), ".json" if "--json-map" in sys.argv[2:] else ".npz", "--png" in sys.argv[2:])
+	else:
+		print("Check usage: python foo.py params.csv [--profile | --profile=cprofile] [--json-map] [--png]")
+		exit()
@@ -9,105 +9,594 @@ Given:
  - Distance from vesicle edge
  - Desired box overlap
  - input CS pick file to use as a template for output
+ - Optionally, the most a pick's box may overlap a pick of a neighbouring vesicle (blank = no limit)
 
 Return:
  - Cryosparc-formatted set of particle picks filtered to remove problem edge cases
 
 Hardcoded to assume all input micrographs are the same size.
 
+The particle-vesicle map is written to ./Particle_data as a columnar .npz (see particle_map.py); add
+--json-map to write the json layout instead.  The vesicle diameter histogram and pick counts per vesicle and
+per micrograph are written to <model>_stats.json (see pick_stats.py); add --png to also plot the histogram
+to <model>_distribution.png.
+
+Add --profile to write per-stage timings to <model>_profile.json, next to the picks (--profile=cprofile to
+also dump cProfile stats per stage).
+
+Add --sweep to compare parameter settings: the box size, extra radial distance, box overlap, internal
+picking and max cross-vesicle overlap rows may then list several values separated by ";" (e.g. 256;320).
+The model and template are loaded once, every combination is counted without writing any particles, and
+the pick counts, edge rejections, picks per vesicle and projected output size of each are printed and
+written to <model>_sweep.csv.  Add --select=K to then write out combination K of the report.
+
+Add --workers=N to pick on N processes.  The vesicle model is sharded by micrograph and every shard gets its
+own block of particle ids, so the output is identical to a single-process run.
+
 """
 
 
 import sys
 import os
-import shutil
-import json
+import io
+import itertools
+import multiprocessing
 import numpy as np 
-from matplotlib import pyplot as plt
 import math
-from math import pi, sin, cos
-from random import randint
+from math import pi
+from cs_io import cs_column, resolve_fields, iter_cs_chunks, micrograph_keys, create_cs, commit_cs, discard_cs
+from vesicle_model import load_model
+from particle_map import from_picks, concatenate_maps, save_map
+from profiling import PROFILE_FLAGS, stage, profiler_from_args
+from spatial_index import GridIndex
+from pick_stats import model_stats
 
 
-def main(params):
-	# Parse input parameters
-	inModel, inCs, box_size_px, px_size, add_dist, set_overlap, set_internal_pick = parse_params(params)
+# Vesicles picked per batch when streaming picks to disk (batches always hold whole micrographs)
+BATCH_VESICLES = 5000
 
-	# Unit conversions
-	add_dist_px = add_dist / px_size
+# Most candidate pick pairs held at once while looking for overlapping neighbours
+SUPPRESS_PAIRS = 2000000
+
+# Params rows that may list several ";"-separated values in a sweep: box size, extra radial distance,
+# box overlap, internal picking and max cross-vesicle overlap
+SWEEP_ROWS = [2, 4, 5, 6, 7]
+
+
+def main(params, profiler=None, map_ext=".npz", workers=1, sweep=False, select=None, png=False):
+	# Parse input parameters
+	if sweep == True:
+		combinations = parse_sweep(params)
+	else:
+		combinations = [parse_params(params)]
+	inModel, inCs, box_size_px, px_size, add_dist, set_overlap, set_internal_pick, max_cross_overlap = combinations[0]
+	if profiler is not None:
+		profiler.report_path = no_ext(inModel)+"_profile.json"
 
 	# Load vesicles from model
-	with open(inModel, "r") as f:
-		vesicle_model = json.load(f)
+	with stage(profiler, "model_load"):
+		vesicle_model = load_model(inModel)
 
-	# For every mcg, generate a set of particle picks for every vesicle
-	print("Picking...")
-	all_radii_px = []
-	new_picks = {}
-	particle_offset = 0
-	counter = 1
-	for mcg in vesicle_model:
-		if counter % 100 == 0:
-			print("\t"+str(counter)+" / "+str(len(vesicle_model.keys()))+" micrographs...")
-		counter += 1
-		for vesicle in vesicle_model[mcg]:
-			all_radii_px.append(vesicle_model[mcg][vesicle]["radius"])
-			# Generate a set of picks (and filter for edges)
-			new_picks, particle_offset = autopick(new_picks, box_size_px, add_dist_px, vesicle_model[mcg][vesicle]["center"][0], vesicle_model[mcg][vesicle]["center"][1], vesicle_model[mcg][vesicle]["radius"], set_overlap, mcg, vesicle_model[mcg][vesicle]["mcg_w"], vesicle_model[mcg][vesicle]["mcg_h"], particle_offset, vesicle, set_internal_pick)
-			mcg_h = vesicle_model[mcg][vesicle]["mcg_h"]
-			mcg_w = vesicle_model[mcg][vesicle]["mcg_w"]
-
-	
-	# Convert the pick coordinates into crysparc format - 0-1 float fraction of length, width
-	new_picks_cs = {}
-	for mcg in new_picks:
-		new_picks_cs[mcg] = []
-		for pick in new_picks[mcg]:
-			new_picks_cs[mcg].append(convert_to_cs(pick, mcg_w, mcg_h))
-
-	
-	# Now need to spoof a cs picking output - god help us this could be rough
-	# Load the input file as a template
 	# I need to find a specific template per-mcg to keep the other factors correct
-	cs_template = np.load(inCs)
-	cs_array, particle_vesicle_map_dict = spoofer(cs_template, new_picks_cs, mcg_h, mcg_w, box_size_px)
+	with stage(profiler, "template_load"):
+		template = load_template(inCs)
+
+	# Sweep mode: report every combination, and only pick for real if one was selected
+	if sweep == True:
+		with stage(profiler, "sweep"):
+			sweep_report(vesicle_model, template, combinations, no_ext(inModel)+"_sweep.csv")
+		if select is None:
+			if profiler is not None:
+				profiler.write_report()
+			return
+		if select > len(combinations):
+			print("Check usage: --select must be between 1 and "+str(len(combinations))+".")
+			exit()
+		inModel, inCs, box_size_px, px_size, add_dist, set_overlap, set_internal_pick, max_cross_overlap = combinations[select-1]
+		print("Writing combination "+str(select)+"...")
 
-	# Write out new cs file
-	np.save("_temp.npy", cs_array)
-	shutil.copy2("_temp.npy", no_ext(inModel)+"_particlesOut.cs")
-	os.remove("_temp.npy")
-	print("\t"+str(len(cs_array))+" particles output to file.")
+	# Unit conversions
+	add_dist_px = add_dist / px_size
+
+	# Pick every vesicle and stream the spoofed particles straight into the new cs file
+	print("Picking...")
+	n_particles, particle_map, all_radii_px = stream_picks(vesicle_model, template, no_ext(inModel)+"_particlesOut.cs", box_size_px, add_dist_px, set_overlap, set_internal_pick, max_cross_overlap, profiler, workers)
+	print("\t"+str(n_particles)+" particles output to file.")
 
-	# Write out the particle-vesicle mapping dictionary as a json
-	if os.path.isdir("./Particle_data") == False:
-		os.mkdir("./Particle_data")
-	with open("./Particle_data/"+no_ext(last_slash(inModel))+"_particles.json", "w") as g:
-		json.dump(particle_vesicle_map_dict, g)
+	# Write out the particle-vesicle map
+	with stage(profiler, "map_write"):
+		write_particle_map(particle_map, "./Particle_data/"+no_ext(last_slash(inModel))+"_particles"+map_ext)
 
 	# Vesicle histogram block
-	print("Outputting vesicle distribution plot...")
-	all_radii_nm = []
-	all_diam_nm = []
-	for i in range(0, len(all_radii_px)):
-		all_radii_nm.append(px_size * all_radii_px[i] / 10)
-		all_diam_nm.append(2 * px_size * all_radii_px[i] / 10)
-	n, bins, patches = plt.hist(all_diam_nm, 30)
-	plt.xlabel("Vesicle diameter (nm)")
-	plt.ylabel("frequency")
-	plt.savefig(no_ext(inModel)+"_distribution.png")
+	print("Outputting vesicle statistics...")
+	with stage(profiler, "histogram"):
+		stats = model_stats(vesicle_model, px_size, particle_map)
+		stats.write_json(no_ext(inModel)+"_stats.json")
+		if png == True:
+			stats.plot_diameters(no_ext(inModel)+"_distribution.png")
 
 	print("\t...done.")
+	if profiler is not None:
+		profiler.write_report()
+
+
+def procedural_pick(vesicle_model, cs_template, box_size_px, add_dist_px, set_overlap, set_internal_pick, max_cross_overlap=None, profiler=None):
+	"""
+	Picks every vesicle of a model and spoofs the picks as cryosparc particles.  cs_template is a cs file
+	or an already-loaded cs array with at least one particle on every micrograph of the model.  With
+	max_cross_overlap set, picks overlapping another vesicle's picks by more than that fraction of the box
+	area are suppressed (see suppress_overlaps).
+
+	Returns the particle array, the particle-vesicle map and the list of vesicle radii (px).
+	"""
+	picks, all_radii_px = pick_model(vesicle_model, box_size_px, add_dist_px, set_overlap, set_internal_pick, max_cross_overlap, profiler)
+
+	# I need to find a specific template per-mcg to keep the other factors correct
+	with stage(profiler, "template_load"):
+		template = load_template(cs_template)
+	with stage(profiler, "spoofer"):
+		print("Converting to cs coords...")
+		cs_array = spoofer(template, picks, box_size_px)
+		particle_map = from_picks(picks, vesicle_model.ves_keys)
+	return cs_array, particle_map, all_radii_px
+
+
+def stream_picks(vesicle_model, template, outCs, box_size_px, add_dist_px, set_overlap, set_internal_pick, max_cross_overlap=None, profiler=None, workers=1):
+	"""
+	Picks every vesicle of a model and writes the spoofed particles to outCs without holding them all in
+	memory.  The model is split into shards of whole micrographs.  A first pass lays out the rings of
+	every shard and counts the picks that survive the edge filter (and cross-vesicle suppression, with
+	max_cross_overlap set); prefix sums of those counts give each shard its rows of the output and its
+	block of particle ids.  The output is then preallocated as a memory-mapped cs file of exactly the right
+	size, a second pass fills in every shard's rows, and the file is renamed into place once complete.
+
+	With workers > 1 both passes run the shards on a process pool, each worker writing straight into the
+	shared output file.  Shards never depend on each other, so the output is byte-identical to a serial
+	run, and to writing procedural_pick's particle array.
+
+	Returns the number of particles written, the particle-vesicle map and the list of vesicle radii (px).
+	"""
+	shards = micrograph_batches(np.asarray(vesicle_model.offsets), BATCH_VESICLES)
+	shard_state = shard_inputs(vesicle_model, template, (box_size_px, add_dist_px, set_overlap, set_internal_pick, max_cross_overlap))
+	pool = None
+	if workers > 1:
+		pool = multiprocessing.Pool(workers, initializer=init_shards, initargs=(shard_state,))
+	else:
+		init_shards(shard_state)
+	run = map if pool is None else pool.map
+
+	try:
+		# Count pass: the ring layout of every shard, and how many of its picks are kept
+		with stage(profiler, "pick_count"):
+			shard_counts = list(run(count_shard, shards))
+		if max_cross_overlap is not None:
+			print("\tSuppressed "+str(sum([removed for rings, count, removed in shard_counts]))+" picks overlapping picks from neighbouring vesicles.")
+
+		# Output rows and particle ids of every shard follow from prefix sums of the counts
+		kept = np.asarray([count for rings, count, removed in shard_counts], dtype=np.int64)
+		laid_out = np.asarray([int(rings["div"].sum()) for rings, count, removed in shard_counts], dtype=np.int64)
+		first_row = np.cumsum(kept) - kept
+		first_uid = np.cumsum(laid_out) - laid_out
+
+		# Fill pass: spoof every shard into its slice of the preallocated output
+		with stage(profiler, "pick_write"):
+			cs_out = create_cs(outCs, template.dtype, int(kept.sum()))
+			try:
+				cs_out.flush()
+				tasks = [(shards[i], shard_counts[i][0], int(first_uid[i]), int(first_row[i]), cs_out.filename) for i in range(0, len(shards))]
+				shard_maps = list(run(fill_shard, tasks))
+			except BaseException:
+				discard_cs(cs_out)
+				raise
+			commit_cs(cs_out, outCs)
+	finally:
+		if pool is not None:
+			pool.close()
+			pool.join()
+
+	return int(kept.sum()), concatenate_maps(shard_maps, vesicle_model.ves_keys), shard_state["radius"].tolist()
+
+
+# Vesicle model, template and settings seen by count_shard and fill_shard (set once per worker process)
+SHARD_STATE = {}
+
+
+def shard_inputs(vesicle_model, template, settings):
+	"""
+	Collects what count_shard and fill_shard need from the vesicle model and template.  settings is
+	(box_size_px, add_dist_px, set_overlap, set_internal_pick, max_cross_overlap).
+	"""
+	return {
+		"offsets": np.asarray(vesicle_model.offsets),
+		"center": np.asarray(vesicle_model.center),
+		"radius": np.asarray(vesicle_model.radius),
+		"ves_mcg": vesicle_model.mcg_index(),
+		"mcg_w": np.asarray(vesicle_model.mcg_w),
+		"mcg_h": np.asarray(vesicle_model.mcg_h),
+		"mcg_keys": micrograph_keys(vesicle_model.mcg_names.tolist()),
+		"ves_keys": np.asarray(vesicle_model.ves_keys),
+		"template": template,
+		"settings": settings,
+	}
+
+
+def init_shards(shard_state):
+	""" Makes the picking inputs available to count_shard and fill_shard in this process. """
+	SHARD_STATE.clear()
+	SHARD_STATE.update(shard_state)
+
+
+def pick_shard(shard, rings=None, first_uid=0):
+	"""
+	Picks the vesicles of one shard (first micrograph, end micrograph), laying out its rings unless given.
+	Returns the ring layout, the kept picks (vesicle indexes local to the shard) and how many were
+	suppressed.
+	"""
+	state = SHARD_STATE
+	box_size_px, add_dist_px, set_overlap, set_internal_pick, max_cross_overlap = state["settings"]
+	start, stop = int(state["offsets"][shard[0]]), int(state["offsets"][shard[1]])
+	center_x = state["center"][start:stop, 0]
+	center_y = state["center"][start:stop, 1]
+	if rings is None:
+		rings = ring_layout(center_x, center_y, state["radius"][start:stop], box_size_px, add_dist_px, set_overlap, set_internal_pick)
+	picks = expand_rings(rings, center_x, center_y, state["ves_mcg"][start:stop], state["mcg_w"], state["mcg_h"], box_size_px, first_uid)
+	picks, removed = suppress_picks(picks, state["ves_mcg"][start:stop], box_size_px, max_cross_overlap)
+	return rings, picks, removed
+
+
+def count_shard(shard):
+	""" Lays out one shard's rings.  Returns the layout, the number of picks kept and the number suppressed. """
+	rings, picks, removed = pick_shard(shard)
+	return rings, len(picks["uid"]), removed
+
+
+def fill_shard(task):
+	"""
+	Picks one shard with its particle ids starting at first_uid, and writes the spoofed particles to the
+	cs output being built at out_path, from first_row on.  Returns the shard's particle-vesicle map.
+	"""
+	shard, rings, first_uid, first_row, out_path = task
+	state = SHARD_STATE
+	rings, picks, removed = pick_shard(shard, rings, first_uid)
+	picks["vesicle"] += int(state["offsets"][shard[0]])
+	picks["mcg_key"] = state["mcg_keys"][state["ves_mcg"][picks["vesicle"]]]
+	cs_block = spoofer(state["template"], picks, state["settings"][0])
+
+	if len(cs_block) > 0:
+		cs_out = np.load(out_path, mmap_mode="r+")
+		cs_out[first_row:first_row+len(cs_block)] = cs_block
+		cs_out.flush()
+		del cs_out
+	return from_picks(picks, state["ves_keys"])
+
+
+def parse_sweep(params):
+	"""
+	Reads a params file whose box size, extra radial distance, box overlap, internal picking and max
+	cross-vesicle overlap rows may each list several values separated by ";".  Returns the parsed
+	parameters (as parse_params) of every combination, in the order they are reported.
+	"""
+	items = read_params(params)
+	choices = []
+	for row in SWEEP_ROWS:
+		if row in sweep_rows(items):
+			choices.append([value.strip() for value in items[row][1].split(";")])
+		else:
+			choices.append([None])
+
+	combinations = []
+	for values in itertools.product(*choices):
+		combo_items = [list(item) for item in items]
+		for row, value in zip(SWEEP_ROWS, values):
+			if value is not None:
+				combo_items[row][1] = value
+		combinations.append(check_params(combo_items, params))
+	return combinations
+
+
+def sweep_report(vesicle_model, template, combinations, outReport):
+	"""
+	Runs the count pass of stream_picks for every parameter combination, writing nothing but a report:
+	picks kept, picks rejected at the micrograph edge, picks suppressed, the spread of picks per vesicle,
+	and the projected size of the output cs file.  The report is printed and written as csv to outReport.
+	"""
+	header = ["combination", "box_size_px", "add_dist_A", "overlap", "internal", "max_cross_overlap", "picks", "edge_rejected", "suppressed", "per_vesicle_min", "per_vesicle_median", "per_vesicle_mean", "per_vesicle_max", "vesicles_unpicked", "projected_mb"]
+	header_bytes = cs_header_size(template.dtype)
+	rows = []
+	for i in range(0, len(combinations)):
+		inModel, inCs, box_size_px, px_size, add_dist, set_overlap, set_internal_pick, max_cross_overlap = combinations[i]
+		stats = sweep_counts(vesicle_model, template, box_size_px, add_dist / px_size, set_overlap, set_internal_pick, max_cross_overlap)
+		per_vesicle = stats["per_vesicle"]
+		projected_mb = (header_bytes + stats["picks"] * template.dtype.itemsize) / 2**20
+		rows.append([
+			i+1, box_size_px, add_dist, set_overlap, "y" if set_internal_pick == True else "n",
+			"" if max_cross_overlap is None else max_cross_overlap,
+			stats["picks"], stats["edge_rejected"], stats["suppressed"],
+			int(per_vesicle.min()) if len(per_vesicle) > 0 else 0,
+			float(np.median(per_vesicle)) if len(per_vesicle) > 0 else 0,
+			round(float(per_vesicle.mean()), 2) if len(per_vesicle) > 0 else 0,
+			int(per_vesicle.max()) if len(per_vesicle) > 0 else 0,
+			int(np.count_nonzero(per_vesicle == 0)),
+			round(projected_mb, 2),
+		])
+
+	# Print, then write the csv
+	for row in rows:
+		print("\t"+str(row[0])+": box "+str(row[1])+" px, +"+str(row[2])+" A, overlap "+str(row[3])+", internal "+row[4]+", cross "+(str(row[5]) if row[5] != "" else "off")
+			+" -> "+str(row[6])+" picks ("+str(row[7])+" at edge, "+str(row[8])+" suppressed), per vesicle "+str(row[9])+"/"+str(row[10])+"/"+str(row[12])+" min/median/max, "+str(row[14])+" MB")
+	with open(outReport, "w") as g:
+		g.write(",".join(header)+"\n")
+		for row in rows:
+			g.write(",".join([str(value) for value in row])+"\n")
+	print("Sweep report written to "+outReport)
+
+
+def sweep_counts(vesicle_model, template, box_size_px, add_dist_px, set_overlap, set_internal_pick, max_cross_overlap):
+	"""
+	Counts the picks of one parameter combination shard by shard without spoofing them.  Returns a dict of
+	picks (kept), edge_rejected, suppressed and per_vesicle (kept picks of every vesicle).
+	"""
+	offsets = np.asarray(vesicle_model.offsets)
+	init_shards(shard_inputs(vesicle_model, template, (box_size_px, add_dist_px, set_overlap, set_internal_pick, max_cross_overlap)))
+	per_vesicle = np.zeros(len(vesicle_model), dtype=np.int64)
+	laid_out, suppressed = 0, 0
+	for shard in micrograph_batches(offsets, BATCH_VESICLES):
+		rings, picks, removed = pick_shard(shard)
+		start, stop = int(offsets[shard[0]]), int(offsets[shard[1]])
+		per_vesicle[start:stop] = np.bincount(picks["vesicle"], minlength=stop-start)
+		laid_out += int(rings["div"].sum())
+		suppressed += removed
+	picks = int(per_vesicle.sum())
+	return {"picks": picks, "edge_rejected": laid_out - picks - suppressed, "suppressed": suppressed, "per_vesicle": per_vesicle}
+
+
+def cs_header_size(cs_dtype):
+	""" Bytes taken by the .npy header of a cs file with this field layout. """
+	header = io.BytesIO()
+	np.save(header, np.zeros(0, dtype=cs_dtype))
+	return len(header.getvalue())
+
+
+def micrograph_batches(offsets, max_vesicles):
+	"""
+	Splits the micrographs into consecutive runs holding at most max_vesicles vesicles between them (or a
+	single micrograph, if it alone holds more).  Returns (first micrograph, end micrograph) pairs.
+	"""
+	batches = []
+	first_mcg = 0
+	n_mcg = len(offsets) - 1
+	while first_mcg < n_mcg:
+		last_mcg = int(np.searchsorted(offsets, offsets[first_mcg] + max_vesicles, side="right")) - 1
+		last_mcg = min(max(last_mcg, first_mcg + 1), n_mcg)
+		batches.append((first_mcg, last_mcg))
+		first_mcg = last_mcg
+	return batches
+
+
+def write_picks(cs_array, outCs):
+	""" Saves a particle array as a cs file, renamed into place once fully written. """
+	cs_out = create_cs(outCs, cs_array.dtype, len(cs_array))
+	try:
+		cs_out[:] = cs_array
+	except BaseException:
+		discard_cs(cs_out)
+		raise
+	commit_cs(cs_out, outCs)
+
+
+def write_particle_map(particle_map, outMap):
+	""" Saves the particle-vesicle map (.npz, or json if outMap ends in .json), creating its folder if needed. """
+	outDir = os.path.dirname(outMap)
+	if (outDir != "") and (os.path.isdir(outDir) == False):
+		os.mkdir(outDir)
+	save_map(particle_map, outMap)
+
+
+def suppress_picks(picks, ves_mcg, box_size_px, max_cross_overlap):
+	"""
+	Drops the picks that suppress_overlaps rejects, if max_cross_overlap is set.  ves_mcg is the
+	micrograph of every vesicle the picks index.  Returns the remaining picks and how many were dropped.
+	"""
+	if max_cross_overlap is None:
+		return picks, 0
+	keep = suppress_overlaps(picks, np.asarray(ves_mcg)[picks["vesicle"]], box_size_px, max_cross_overlap)
+	return {column: picks[column][keep] for column in picks}, int(np.count_nonzero(~keep))
+
+
+def suppress_overlaps(picks, pick_mcg, box_size_px, max_overlap):
+	"""
+	Finds the picks whose box covers more than max_overlap of the box of a pick from a different vesicle
+	on the same micrograph.  Picks are accepted greedily in order, so of two conflicting picks the one from
+	the vesicle listed first survives, and a pick whose only conflicts were themselves suppressed is kept.
+	Picks of the same vesicle never suppress each other.
+
+	Neighbours come from a grid spatial index with box-sized cells, so the work grows linearly with the
+	number of picks.  Returns a boolean mask of the picks to keep.
+	"""
+	n_picks = len(picks["x"])
+	if n_picks == 0:
+		return np.ones(0, dtype=bool)
+
+	# Rank every vesicle among the vesicles of its micrograph.  Picks are settled one rank at a time: a pick
+	# survives unless it conflicts with a surviving pick of a lower rank, all of which are already settled.
+	ves_list, ves_first = np.unique(picks["vesicle"], return_index=True)
+	ves_mcg = pick_mcg[ves_first]
+	ves_order = np.lexsort((ves_list, ves_mcg))
+	mcg_list, mcg_first = np.unique(ves_mcg[ves_order], return_index=True)
+	ves_rank = np.empty(len(ves_list), dtype=np.int64)
+	ves_rank[ves_order] = np.arange(len(ves_list)) - np.repeat(mcg_first, np.diff(np.append(mcg_first, len(ves_list))))
+	pick_rank = ves_rank[np.searchsorted(ves_list, picks["vesicle"])]
+
+	# Sort the picks by rank once (stably, so each rank keeps pick order) and take every rank as a slice
+	rank_order = np.argsort(pick_rank, kind="stable")
+	rank_start = np.searchsorted(pick_rank[rank_order], np.arange(int(pick_rank.max()) + 2))
+
+	# Conflicting boxes are within a box diagonal of each other.  Dense rings give every pick many close
+	# neighbours, so queries run in blocks sized to keep the candidate pairs under SUPPRESS_PAIRS.
+	pick_index = GridIndex(picks["x"], picks["y"], pick_mcg, cell_size=box_size_px)
+	block_size = max(1, SUPPRESS_PAIRS // (25 * int(pick_index.cell_counts.max())))
+	kept = np.ones(n_picks, dtype=bool)
+	for rank in range(1, int(pick_rank.max()) + 1):
+		rank_picks = rank_order[rank_start[rank]:rank_start[rank+1]]
+		for start in range(0, len(rank_picks), block_size):
+			block = rank_picks[start:start+block_size]
+			query, neighbour, distance = pick_index.query_radius(picks["x"][block], picks["y"][block], box_size_px * math.sqrt(2), pick_mcg[block])
+			query = block[query]
+			settled = kept[neighbour] & (pick_rank[neighbour] < rank)
+			overlap_w = np.clip(box_size_px - np.abs(picks["x"][neighbour] - picks["x"][query]), 0, None)
+			overlap_h = np.clip(box_size_px - np.abs(picks["y"][neighbour] - picks["y"][query]), 0, None)
+			conflict = settled & (overlap_w * overlap_h > max_overlap * box_size_px**2)
+			kept[query[conflict]] = False
+	return kept
+
+
+def parse_cross_overlap(items):
+	"""
+	Reads the optional Max Cross-Vesicle Overlap row of a params file: None if the row is missing or blank.
+	"""
+	if (len(items) < 8) or (len(items[7]) < 2) or (items[7][1].strip() == ""):
+		return None
+	return float(items[7][1].strip())
+
+
+def pick_model(vesicle_model, box_size_px, add_dist_px, set_overlap, set_internal_pick, max_cross_overlap=None, profiler=None):
+	"""
+	Runs the pick engine over every vesicle of the model, then cross-vesicle suppression if
+	max_cross_overlap is set.  Returns the pick columns (see pick_engine), extended with the micrograph
+	uid (mcg_key) of every pick, and the list of vesicle radii.
+	"""
+	ves_mcg = vesicle_model.mcg_index()
+	with stage(profiler, "autopick"):
+		picks = pick_engine(vesicle_model.center[:, 0], vesicle_model.center[:, 1], vesicle_model.radius, ves_mcg, vesicle_model.mcg_w, vesicle_model.mcg_h, box_size_px, add_dist_px, set_overlap, set_internal_pick)
+	if max_cross_overlap is not None:
+		with stage(profiler, "suppression"):
+			picks, n_suppressed = suppress_picks(picks, ves_mcg, box_size_px, max_cross_overlap)
+		print("\tSuppressed "+str(n_suppressed)+" picks overlapping picks from neighbouring vesicles.")
+	picks["mcg_key"] = micrograph_keys(vesicle_model.mcg_names.tolist())[ves_mcg[picks["vesicle"]]]
+
+	return picks, vesicle_model.radius.tolist()
+
+
+def pick_engine(center_x, center_y, radius, ves_mcg, mcg_w, mcg_h, box_size_px, add_dist_px, set_overlap, set_internal_pick, first_uid=0):
+	"""
+	Generates procedural picks for a whole dataset at once.  Vesicles are given as flat arrays of centers,
+	radii (px) and micrograph index; mcg_w and mcg_h are per-micrograph sizes.  Each vesicle gets a ring of
+	boxes at radius + add_dist_px, and with set_internal_pick further concentric rings stepped inwards by
+	the box spacing for as long as the ring above held more than three boxes.
+
+	Returns a dict of pick columns in vesicle, ring, angle order: vesicle (index into the inputs), ring
+	(0 outermost), topology (code into particle_map.TOPOLOGIES: ring 0 is external, inner rings internal),
+	x, y (px), x_frac, y_frac, angle, r_eff and uid.  uids count up from first_uid and are numbered before
+	picks off the micrograph edge are dropped.
+	"""
+	rings = ring_layout(center_x, center_y, radius, box_size_px, add_dist_px, set_overlap, set_internal_pick)
+	return expand_rings(rings, center_x, center_y, ves_mcg, mcg_w, mcg_h, box_size_px, first_uid)
+
+
+def ring_layout(center_x, center_y, radius, box_size_px, add_dist_px, set_overlap, set_internal_pick):
+	"""
+	Works out every ring of picks before any pick is placed: ring 0 for every vesicle, then inner rings
+	while the last one had more than three boxes.  Each depth is solved for all vesicles that reach it in
+	one ring_counts call, so the work is one vectorized pass per ring depth rather than per vesicle.
+	Returns a dict of ring columns in vesicle, ring order: vesicle, ring, r_eff and div (number of boxes).
+	"""
+	center_x = np.asarray(center_x, dtype=np.float64)
+	center_y = np.asarray(center_y, dtype=np.float64)
+	ring_ves, ring_level, ring_r_eff, ring_div = [], [], [], []
+	active = np.arange(len(center_x))
+	r = np.asarray(radius, dtype=np.float64)
+	level = 0
+	while len(active) > 0:
+		r_eff = r + add_dist_px
+		div = ring_counts(center_x[active], center_y[active], r_eff, box_size_px, set_overlap)
+		ring_ves.append(active)
+		ring_level.append(np.full(len(active), level, dtype=np.int64))
+		ring_r_eff.append(r_eff)
+		ring_div.append(div)
+		if set_internal_pick != True:
+			break
+		inner = div > 3
+		active = active[inner]
+		r = r[inner] - (box_size_px * (1 - set_overlap))
+		level += 1
+	ring_ves = np.concatenate(ring_ves)
+	ring_level = np.concatenate(ring_level)
+	order = np.lexsort((ring_level, ring_ves))
+	return {
+		"vesicle": ring_ves[order],
+		"ring": ring_level[order],
+		"r_eff": np.concatenate(ring_r_eff)[order],
+		"div": np.concatenate(ring_div)[order],
+	}
+
+
+def expand_rings(rings, center_x, center_y, ves_mcg, mcg_w, mcg_h, box_size_px, first_uid=0):
+	"""
+	Expands a ring layout into its picks and drops the picks too close to the micrograph edge.  See
+	pick_engine for the columns returned.
+	"""
+	center_x = np.asarray(center_x, dtype=np.float64)
+	center_y = np.asarray(center_y, dtype=np.float64)
+	ves_mcg = np.asarray(ves_mcg, dtype=np.int64)
+	ring_div = rings["div"]
+
+	first_pick = np.cumsum(ring_div) - ring_div
+	pick_ring = np.repeat(np.arange(len(ring_div)), ring_div)
+	pick_offset = np.arange(len(pick_ring), dtype=np.int64)
+	alpha = 2 * pi / ring_div
+	angle = (pick_offset - first_pick[pick_ring]) * alpha[pick_ring]
+	pick_r_eff = rings["r_eff"][pick_ring]
+	pick_ves = rings["vesicle"][pick_ring]
+	pick_x = center_x[pick_ves] + pick_r_eff * np.cos(angle)
+	pick_y = center_y[pick_ves] + -1 * pick_r_eff * np.sin(angle)
+
+	# Edge filter
+	pick_w = np.asarray(mcg_w)[ves_mcg[pick_ves]]
+	pick_h = np.asarray(mcg_h)[ves_mcg[pick_ves]]
+	keep = (pick_x > 0) & (pick_x < pick_w - box_size_px) & (pick_y > 0) & (pick_y < pick_h - box_size_px)
+
+	return {
+		"vesicle": pick_ves[keep],
+		"ring": rings["ring"][pick_ring][keep],
+		"topology": (rings["ring"][pick_ring][keep] > 0).astype(np.uint8),
+		"x": pick_x[keep],
+		"y": pick_y[keep],
+		"x_frac": pick_x[keep] / pick_w[keep],
+		"y_frac": pick_y[keep] / pick_h[keep],
+		"angle": angle[keep],
+		"r_eff": pick_r_eff[keep],
+		"uid": np.uint64(9000000000000000000 + first_uid) + pick_offset[keep].astype(np.uint64),
+	}
 
 
 def parse_params(params):
 	# Load and read csv input
-	kill_flag = False
+	items = read_params(params)
+	if len(sweep_rows(items)) > 0:
+		print("Check parameters: several values are given for one parameter; run with --sweep to compare them.")
+		print("Please fix the parameters file and try again: "+params)
+		exit()
+	return check_params(items, params)
+
+
+def read_params(params):
+	""" Reads a params csv into a list of its rows, each split on commas. """
 	with open(params, "r") as f:
 		lines = f.readlines()
 		items = []
 		for i in range(0, len(lines)):
 			items.append(lines[i].split(","))
-	
+	return items
+
+
+def sweep_rows(items):
+	""" Rows of a params file that list several ";"-separated values. """
+	return [row for row in SWEEP_ROWS if (row < len(items)) and (len(items[row]) > 1) and (";" in items[row][1])]
+
+
+def check_params(items, params):
+	kill_flag = False
+
 	# Item definitions
 	inModel = items[0][1].strip()
 	inCs = items[1][1].strip()
@@ -128,6 +617,10 @@ def parse_params(params):
 		set_internal_pick = True
 	else:
 		set_internal_pick = False
+	max_cross_overlap = parse_cross_overlap(items)
+	if (max_cross_overlap is not None) and ((max_cross_overlap > 1.0) or (max_cross_overlap < 0.0)):
+		print("Check parameters: Max Cross-Vesicle Overlap must be between 0 and 1, or blank.")
+		kill_flag = True
 
 	# Make sure all params are actually populated
 	length_list = []
@@ -146,10 +639,25 @@ def parse_params(params):
 		print("Please fix the parameters file and try again: "+params)
 		exit()
 	else:
-		return inModel, inCs, box_size_px, px_size, add_dist, set_overlap, set_internal_pick
+		return inModel, inCs, box_size_px, px_size, add_dist, set_overlap, set_internal_pick, max_cross_overlap
 
 
-def spoofer(template, pick_dict, mcg_h, mcg_w, box):
+def load_template(inCs):
+	"""
+	Streams the template cs file and keeps only the first particle of every micrograph, which is all the
+	spoofer needs.
+	"""
+	template_blocks = []
+	seen_keys = np.zeros(0, dtype=np.uint64)
+	for start, block in iter_cs_chunks(inCs):
+		keys, first_rows = np.unique(cs_column(block, "mcg_uid"), return_index=True)
+		is_new = ~np.isin(keys, seen_keys)
+		template_blocks.append(block[np.sort(first_rows[is_new])])
+		seen_keys = np.concatenate((seen_keys, keys[is_new]))
+	return np.concatenate(template_blocks)
+
+
+def spoofer(template, picks, box):
 	"""
 	Needs to adjust the following indeces from template:
 	   0  Particle identifier - 19-digit random int, starting with a 9
@@ -164,165 +672,112 @@ def spoofer(template, pick_dict, mcg_h, mcg_w, box):
 
 	* Features that can pass through directly from an appropriate template
 
+	picks are pick columns from pick_model.  Every output row starts as a copy of the first template row on
+	the pick's micrograph, and the rest is assigned a column at a time.
+	"""
+	# Find the first row of every micrograph in the template array
+	template_keys, first_rows = np.unique(cs_column(template, "mcg_uid"), return_index=True)
+	slot = np.searchsorted(template_keys, picks["mcg_key"])
+	slot[slot == len(template_keys)] = 0
+	missing = template_keys[slot] != picks["mcg_key"]
+	if np.count_nonzero(missing) > 0:
+		raise KeyError("template has no particles on micrograph "+str(picks["mcg_key"][missing][0]))
+
+	# Copy a template row per pick, then overwrite the id, box size and location columns
+	fields = resolve_fields(template.dtype)
+	spoof_array = template[first_rows[slot]]
+	spoof_array[fields["uid"]] = picks["uid"]
+	spoof_array[fields["box_shape"]] = box
+	spoof_array[fields["x_frac"]] = picks["x_frac"]
+	spoof_array[fields["y_frac"]] = picks["y_frac"]
+
+	return spoof_array
+
+
+def ring_counts(x, y, r_eff, box_size_px, user_overlap):
+	"""
+	Returns the number of boxes to place around each ring (arrays of centers and effective radii): the
+	smallest div >= 3 at which the first two boxes reach user_overlap, as measured by ring_overlaps on
+	their pixel coordinates.
+
+	For rings of positive radius and four or more boxes, adding a box moves the first two boxes closer in
+	both x and y, so the overlap never drops as div grows.  The answer is then bracketed around the
+	arc-length estimate 2*pi*r_eff / (box*(1-overlap)) and pinned down by bisection, testing a handful of
+	divs per ring instead of every one.  All rings are searched together.
 	"""
-	print("Converting to cs coords...")
-	# Create a dict to map the micrographs to their first index in template array
-	map_dict = {}
-	for i in range(0, len(template)):
-		this_key = template[i][7]
-		if this_key not in map_dict:
-			map_dict[this_key] = i
-
-	# Create a dictionary to correlate particles with vesicles and picking data
-	particle_vesicle_map_dict = {}
-	for mcg in pick_dict:
-		for each_pick in pick_dict[mcg]:
-			particle_vesicle_map_dict[each_pick[2]] = {}
-			particle_vesicle_map_dict[each_pick[2]]["x"] = each_pick[0]
-			particle_vesicle_map_dict[each_pick[2]]["y"] = each_pick[1]
-			particle_vesicle_map_dict[each_pick[2]]["ves_id"] = each_pick[3]
-			particle_vesicle_map_dict[each_pick[2]]["angle"] = each_pick[4]
-			particle_vesicle_map_dict[each_pick[2]]["r_eff"] = each_pick[5]
-			particle_vesicle_map_dict[each_pick[2]]["topology"] = each_pick[6]
-
-	# Get total number of picks
-	all_picks = 0
-	for mcg in pick_dict:
-		for pick in pick_dict[mcg]:
-			all_picks += 1
-
-	# Iteration cycle - generate a cs item for every pick
-	spoof_arrays = []
-	for mcg in pick_dict:
-		# Grab the appropriate template
-		specific_template = template[map_dict[get_key(mcg)]]
-		# Mod for each pick
-		for pick in pick_dict[mcg]:
-			cs_pick = specific_template.copy()
-
-			# Index 0 - 19-digit particle ID
-			cs_pick[0] = pick[2]
-
-			# Index 1 - Particle Name
-			#particle_name = cs_pick[1].decode("ascii")
-			#slash_loc = last_slash_loc(particle_name)
-			#prefix = particle_name[0:last_slash_loc+1]
-
-			# Index 3 - Box size
-			cs_pick[3] = np.asarray([box, box])
-
-			# Index 11 and 12 - pick locations in y and x, respectively
-			cs_pick[11] = pick[0]
-			cs_pick[12] = pick[1]
-
-			# Load onto list
-			spoof_arrays.append(cs_pick)
-
-	# Convert list to numpy array
-	spoof_array = np.array(spoof_arrays)
-
-	return spoof_array, particle_vesicle_map_dict
-
-
-def get_key(inStr):
-	work_str = last_slash(inStr)
-	under_loc = work_str.find("_")
-	return int(work_str[0:under_loc])
-
-
-def convert_to_cs(pick, w, h):
-	x = pick[0]
-	y = pick[1]
-	new_x = x / w
-	new_y = y / h
-	return(new_x, new_y, pick[2], pick[3], pick[4], pick[5], pick[6])
-
-
-def autopick(pick_dict, box_size_px, add_dist, x, y, r, user_overlap, in_mcg, mcg_w, mcg_h, particle_offset, vesicle, set_internal_pick):
-	""" Given the effective radius, box_size, and overlap, figure out how to acheive the necessary overlap """
-	
-	# Distance from center of circle to center of pick, pre-calculations
-	r_eff = r + add_dist
 	box_area_px = box_size_px ** 2
 
-	# Given the desired radius, place three boxes, then increase the number until the overlap
-	# is where the user wants it
-	div = 2
-	calc_overlap = float(0)
-	while calc_overlap < user_overlap:
-		div += 1
-		picks = []
-
-		# At this div setting, define coords for every box at this position as tuples -> picks list
-		alpha = 2 * pi / div
-		for i in range(0, div):	
-			angle = i * alpha
-			l_T = r_eff * cos(angle)
-			h_T = -1 * r_eff * sin(angle)
-			pick_x = x + l_T# - box_size_px/2
-			pick_y = y + h_T# - box_size_px/2
-			# Pass forward as (x, y, partID, vesID, angle, r_eff, topology)
-			picks.append((pick_x, pick_y, 9000000000000000000+particle_offset, vesicle, angle, r_eff, "external"))
-			particle_offset += 1
-
-		# Calculate overlap between the first two boxes in the pick list
-		calc_overlap = get_overlap(int(picks[0][0]), int(picks[0][1]), int(picks[1][0]), int(picks[1][1]), box_size_px, box_area_px)
-
-	# picks now contains the coords of new picks.
-	filtered_picks = filter_picks(picks, box_size_px, mcg_w, mcg_h)
-
-	# Add filtered output to the pick dictionary and send back
-	if in_mcg not in pick_dict:
-		pick_dict[in_mcg] = []
-	for pick in filtered_picks:
-		pick_dict[in_mcg].append(pick)
-
-	# Recursion loop for internal templated picking
-	if set_internal_pick == True:
-		recursion_flag = False
-		if div > 3:
-			new_radius = r - (box_size_px * (1 - user_overlap))
-			new_picks, particle_offset = autopick(pick_dict, box_size_px, add_dist, x, y, new_radius, user_overlap, in_mcg, mcg_w, mcg_h, particle_offset, vesicle, set_internal_pick)
-
-	return pick_dict, particle_offset
-
-
-def get_overlap(x1, y1, x2, y2, box_size, box_area):
+	def falls_short(rows, div):
+		return ring_overlaps(x[rows], y[rows], r_eff[rows], div, box_size_px, box_area_px) < user_overlap
+
+	all_rows = np.arange(len(x))
+	div = np.full(len(x), 3, dtype=np.int64)
+	short = falls_short(all_rows, div)
+
+	# No ordering to exploit without a positive radius, so step those rings through every div in turn
+	stepped = all_rows[short & ((r_eff <= 0) | (user_overlap >= 1))]
+	div[stepped] = 4
+	while len(stepped) > 0:
+		stepped = stepped[falls_short(stepped, div[stepped])]
+		div[stepped] += 1
+
+	# Bracket the answer with lo falling short and hi reaching the overlap, stepping out from the estimate
+	rows = all_rows[short & (r_eff > 0) & (user_overlap < 1)]
+	lo = np.full(len(rows), 3, dtype=np.int64)
+	hi = np.maximum(4, (2 * pi * r_eff[rows] / (box_size_px * (1 - user_overlap))).astype(np.int64))
+	step = np.ones(len(rows), dtype=np.int64)
+	up = falls_short(rows, hi)
+	going = np.flatnonzero(up)
+	while len(going) > 0:
+		lo[going] = hi[going]
+		hi[going] += step[going]
+		step[going] *= 2
+		going = going[falls_short(rows[going], hi[going])]
+	going = np.flatnonzero(~up)
+	going = going[hi[going] - step[going] > lo[going]]
+	while len(going) > 0:
+		below = falls_short(rows[going], hi[going] - step[going])
+		lo[going[below]] = hi[going[below]] - step[going[below]]
+		going = going[~below]
+		hi[going] -= step[going]
+		step[going] *= 2
+		going = going[hi[going] - step[going] > lo[going]]
+
+	# Bisect down to the first div that reaches the overlap
+	going = np.flatnonzero(hi - lo > 1)
+	while len(going) > 0:
+		mid = (lo[going] + hi[going]) // 2
+		below = falls_short(rows[going], mid)
+		lo[going[below]] = mid[below]
+		hi[going[~below]] = mid[~below]
+		going = going[hi[going] - lo[going] > 1]
+	div[rows] = hi
+
+	return div
+
+
+def ring_overlaps(x, y, r_eff, div, box_size_px, box_area_px):
+	"""
+	Overlap between the first two boxes of rings of div boxes, at their truncated pixel coordinates: 0 if
+	the boxes don't meet, else (2*box_area - overlap_area) / box_area.
+	"""
+	alpha = 2 * pi / div
+	x1 = np.trunc(x + r_eff * np.cos(0.0))
+	y1 = np.trunc(y + -1 * r_eff * np.sin(0.0))
+	x2 = np.trunc(x + r_eff * np.cos(alpha))
+	y2 = np.trunc(y + -1 * r_eff * np.sin(alpha))
+
 	# Define pick square edges
-	x1_1 = x1 - (box_size/2)
-	x1_2 = x1 + (box_size/2)
-	y1_1 = y1 - (box_size/2)
-	y1_2 = y1 + (box_size/2)
-	x2_1 = x2 - (box_size/2)
-	x2_2 = x2 + (box_size/2)
-	y2_1 = y2 - (box_size/2)
-	y2_2 = y2 + (box_size/2)
-
-	# Exit if there is no overlap
-	if (x1_2 <= x2_1) or (y1_2 <= y2_1):
-		return float(0)
-	else: # Calculate if we know we have overlap
-		overlap_area = (x1_2 - x2_1) * (y1_2 - y2_1)
-		return ((2*box_area) - overlap_area) / box_area
-
-
-def filter_picks(picks, box_size, mcg_w, mcg_h):
-	# Define upper and lower bounds in x and y for picks
-	min_x = 0
-	min_y = 0
-	max_x = mcg_w - box_size
-	max_y = mcg_h - box_size
-	
-	# Filter!
-	out_picks = []
-	for pick in picks:
-		if (pick[0] > min_x):
-			if (pick[0] < max_x):
-				if (pick[1] > min_y):
-					if (pick[1] < max_y):
-						out_picks.append(pick)
-
-	return out_picks
+	x1_2 = x1 + (box_size_px/2)
+	y1_2 = y1 + (box_size_px/2)
+	x2_1 = x2 - (box_size_px/2)
+	y2_1 = y2 - (box_size_px/2)
+
+	# No overlap scores zero
+	overlap_area = (x1_2 - x2_1) * (y1_2 - y2_1)
+	overlap = ((2*box_area_px) - overlap_area) / box_area_px
+	overlap[(x1_2 <= x2_1) | (y1_2 <= y2_1)] = 0
+	return overlap
 
 
 def last_slash(inStr):
@@ -361,9 +816,38 @@ def no_ext(inStr):
 	return inStr[0:prevPos]
 
 
+def parse_workers(args):
+	"""
+	Reads --workers=N from the command line flags.  Returns 1 if it isn't given, or None if N isn't a
+	positive integer.
+	"""
+	workers = 1
+	for arg in args:
+		if arg.startswith("--workers="):
+			if (arg[10:].isdigit() == False) or (int(arg[10:]) < 1):
+				return None
+			workers = int(arg[10:])
+	return workers
+
+
+def parse_select(args):
+	"""
+	Reads --select=K from the command line flags.  Returns None if it isn't given, or 0 if K isn't a
+	positive integer.
+	"""
+	for arg in args:
+		if arg.startswith("--select="):
+			if (arg[9:].isdigit() == False) or (int(arg[9:]) < 1):
+				return 0
+			return int(arg[9:])
+	return None
+
+
 if __name__ == "__main__":
-	if len(sys.argv) == 2:
-		main(sys.argv[1])
+	flags = sys.argv[2:]
+	known = all([((arg in PROFILE_FLAGS) or (arg in ["--json-map", "--sweep", "--png"]) or arg.startswith("--workers=") or arg.startswith("--select=")) for arg in flags])
+	if (len(sys.argv) >= 2) and known and (parse_workers(flags) is not None) and (parse_select(flags) != 0) and ((parse_select(flags) is None) or ("--sweep" in flags)):
+		main(sys.argv[1], profiler_from_args(flags), ".json" if "--json-map" in flags else ".npz", parse_workers(flags), "--sweep" in flags, parse_select(flags), "--png" in flags)
 	else:
-		print("Check usage: python foo.py params.csv")
+		print("Check usage: python foo.py params.csv [--profile | --profile=cprofile] [--json-map] [--png] [--workers=N] [--sweep [--select=K]]")
 		exit()